@@ -38,7 +38,94 @@ ipcMain.on('open-file-dialog-for-file', (event) => {
     });
 });
 
+// Progressive exports print a JSON message (e.g. `{"type": "preview", ...}`) on its own line as soon as each preview
+// pass is ready; pass those on to the renderer straight away, instead of waiting for the script to finish
+function forwardProgressMessage(sender, line) {
+  if (typeof line !== 'string' || !line.startsWith('{')) {
+    return;
+  }
+  try {
+    let message = JSON.parse(line);
+    if (message.type) {
+      sender.send('python-progress', message);
+    }
+  } catch (err) {
+    // Not one of our messages, just something that happened to start with a brace
+  }
+}
+
+// Scripts that can run as a resident worker (see `run_worker` in takeVideoCrossSection.py), so each export doesn't
+// pay for starting Python and importing cv2/numpy again
+const workerScripts = ['takeVideoCrossSection.py'];
+let pythonWorker = null;
+let nextRequestId = 0;
+const pendingRequests = new Map();
+
+function getPythonWorker(scriptName) {
+  if (pythonWorker) {
+    return pythonWorker;
+  }
+
+  let options = {
+    mode: 'json',
+    pythonOptions: ['-u'],
+    scriptPath: './smaller_scripts/',
+    args: ['worker']
+  }
+
+  pythonWorker = new PythonShell(scriptName, options);
+
+  pythonWorker.on('message', function(response) {
+    let request = pendingRequests.get(response.id);
+    if (!request) {
+      console.log(response);
+      return;
+    }
+    pendingRequests.delete(response.id);
+    if (response.ok) {
+      request.resolve(response.output);
+    } else {
+      request.reject(response.error);
+    }
+  });
+
+  // Anything the script prints while handling a request ends up on stderr. Requests are handled one at a time, so
+  // progress messages belong to the oldest pending request.
+  pythonWorker.on('stderr', function(line) {
+    console.log(line);
+    let current = pendingRequests.values().next().value;
+    if (current) {
+      forwardProgressMessage(current.sender, line);
+    }
+  });
+
+  // If the worker dies, fail whatever it was working on; a fresh one is started with the next request
+  let worker = pythonWorker;
+  function workerStopped(err) {
+    for (let request of pendingRequests.values()) {
+      request.reject(err ? err.toString() : 'Python worker exited');
+    }
+    pendingRequests.clear();
+    if (pythonWorker === worker) {
+      pythonWorker = null;
+    }
+  }
+  pythonWorker.on('error', workerStopped);
+  pythonWorker.on('pythonError', workerStopped);
+  pythonWorker.on('close', () => workerStopped());
+
+  return pythonWorker;
+}
+
 ipcMain.handle('run-python-script', (event, scriptName, args) => {
+  if (workerScripts.includes(scriptName)) {
+    return new Promise((resolve, reject) => {
+      let id = nextRequestId++;
+      pendingRequests.set(id, {resolve: resolve, reject: reject, sender: event.sender});
+      getPythonWorker(scriptName).send({id: id, args: args});
+    });
+  }
+
   return new Promise((resolve, reject) => {
     let options = {
       mode: 'text',
@@ -53,6 +140,7 @@ ipcMain.handle('run-python-script', (event, scriptName, args) => {
     shell.on('message', function(message) {
       console.log(message);  // This will print python print statements in node console
       output.push(message);
+      forwardProgressMessage(event.sender, message);
     });
 
     shell.end(function (err) {
@@ -65,4 +153,9 @@ ipcMain.handle('run-python-script', (event, scriptName, args) => {
   });
 });
 
-
+app.on('will-quit', () => {
+  if (pythonWorker) {
+    pythonWorker.send({type: 'shutdown'});
+    pythonWorker.end(() => {});
+  }
+});
@@ -3,6 +3,7 @@
 // When node integration is turned off,
 // the script can reintroduce Node global symbols back to the global scope
 const { contextBridge, ipcRenderer } = require('electron')
+const { pathToFileURL } = require('url');
 
 window.getSystemInfo = require('./smaller_scripts/getSystemInfo.js');
 window.convertVideo = require('./smaller_scripts/resizeAndPlyify.js');
@@ -13,3 +14,15 @@ window.uploadNewVideoFile = require('./smaller_scripts/uploadVideoButton.js');
 window.runPythonScript = (scriptName, args) => {
   return ipcRenderer.invoke('run-python-script', scriptName, args);
 }
+
+// Progress messages (like preview images from a progressive export) arrive here while the Python script is still
+// running, by calling `window.onPythonProgress(message => { ... })`. Messages that point at a file also get a `url`
+// the page can load it from.
+window.onPythonProgress = (callback) => {
+  ipcRenderer.on('python-progress', (event, message) => {
+    if (message.path) {
+      message.url = pathToFileURL(message.path).href;
+    }
+    callback(message);
+  });
+}
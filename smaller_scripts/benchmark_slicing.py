@@ -0,0 +1,281 @@
+# Benchmarks for the slicing pipeline.
+#     Synthetic test videos are generated locally with `cv2.VideoWriter` (moving gradients and shapes, so every frame
+#     is different), at a few resolutions and lengths.
+#     `create_cross_section`, `create_animation`, `create_animation_optimized`, `images_to_video` and `shuffle_ply_file`
+#     are timed across several plane orientations (axis-aligned, oblique, and partly out of bounds) and resolution
+#     percentages, with the decoded-volume cache both off and warm.
+#     Every cross-section and animation is also checked against a straightforward per-pixel reference implementation
+#     (the original algorithm), and must come out pixel-identical.
+#     Results are written to JSON, and can be compared against a stored baseline run.
+#
+# Example:
+#     python benchmark_slicing.py --output bench.json
+#     python benchmark_slicing.py --output bench_new.json --baseline bench.json
+import argparse
+import contextlib
+import copy
+import datetime
+import io
+import json
+import os
+import platform
+import statistics
+import sys
+import tempfile
+import time
+
+import cv2
+import numpy as np
+from PIL import Image
+
+from video_capture import open_capture
+
+# (width, height, frames) of the synthetic videos
+FIXTURES = {
+    'small': (160, 120, 60),
+    'medium': (640, 360, 150),
+    'large': (1280, 720, 300),
+}
+
+# Planes in three.js space (top left, top right and bottom left corners)
+ORIENTATIONS = {
+    'axis-aligned': [[0, 0, 50], [100, 0, 50], [0, 100, 50]],
+    'oblique': [[51.787123933939604, -1.2069462425104982, -7.17036082012239],
+                [104.91694554306812, 21.7691466321827, 74.38618749385326],
+                [54.622052382430184, 67.39184842565481, 9.830320134079496]],
+    'out-of-bounds': [[60, 60, 60], [160, 60, 90], [60, 160, 60]],
+}
+
+# Start and end planes of the benchmarked animations, matched to the orientations above
+ANIMATIONS = {
+    'axis-aligned': ([[0, 0, 10], [100, 0, 10], [0, 100, 10]], [[0, 0, 90], [100, 0, 90], [0, 100, 90]]),
+    'oblique': ([[0, 0, 5], [100, 0, 40], [0, 100, 5]], [[0, 0, 55], [100, 0, 95], [0, 100, 55]]),
+    'out-of-bounds': ([[50, 50, 10], [150, 50, 30], [50, 150, 10]], [[50, 50, 70], [150, 50, 90], [50, 150, 70]]),
+}
+
+RESOLUTIONS = [25, 50, 100]
+
+
+# Write a synthetic video, if it doesn't exist yet, and return its path
+def make_fixture(fixture_dir, name, width, height, frames, fps=30):
+    path = os.path.join(fixture_dir, f'{name}_{width}x{height}x{frames}.mp4')
+    if os.path.isfile(path):
+        return path
+    video = cv2.VideoWriter(path, cv2.VideoWriter_fourcc(*'mp4v'), fps, (width, height))
+    xs = np.arange(width, dtype=np.int64)
+    ys = np.arange(height, dtype=np.int64)
+    for frame_index in range(frames):
+        frame = np.empty((height, width, 3), dtype=np.uint8)
+        frame[..., 0] = ((xs[np.newaxis, :] + frame_index * 3) * 255 // width) % 256
+        frame[..., 1] = ((ys[:, np.newaxis] + frame_index * 2) * 255 // height) % 256
+        frame[..., 2] = (frame_index * 255 // frames)
+        center = (frame_index * width // frames, height // 2 + int(height / 4 * np.sin(frame_index / 7)))
+        cv2.circle(frame, center, max(4, height // 10), (255, 255, 255), -1)
+        cv2.rectangle(frame, (width // 4, height // 4), (width // 4 + frame_index % (width // 2), height // 3),
+                      (0, 0, 0), -1)
+        video.write(frame)
+    video.release()
+    return path
+
+
+def _decode_all(video_path):
+    cap = open_capture(video_path)
+    frames = []
+    while True:
+        ret, frame = cap.read()
+        if not ret:
+            break
+        frames.append(frame)
+    cap.release()
+    return frames
+
+
+# Reference implementation of a cross-section: the original per-pixel algorithm (plane corners scaled from three.js
+# space, segment centers rounded with Python's `round`, black outside the video). Returns an RGB uint8 image.
+def reference_cross_section(frames, width, height, duration, points, resolutions):
+    p1, p2, p3 = copy.deepcopy(points)
+    scaling_factors = [width / 100, height / 100, duration / 100]
+    for point in (p1, p2, p3):
+        for i in range(3):
+            point[i] *= scaling_factors[i]
+    width_res = int(resolutions[0] * width / 100)
+    height_res = int(resolutions[1] * height / 100)
+    return _reference_plane(frames, width, height, duration, p1, p2, p3, width_res, height_res)
+
+
+def _reference_plane(frames, width, height, duration, p1, p2, p3, width_res, height_res):
+    width_vector = [(p2[i] - p1[i]) / width_res for i in range(3)]
+    height_vector = [(p3[i] - p1[i]) / height_res for i in range(3)]
+    image = np.zeros((height_res, width_res, 3), dtype=np.uint8)
+    for i in range(height_res):
+        for j in range(width_res):
+            x, y, z = [round(p1[k] + (j + 0.5) * width_vector[k] + (i + 0.5) * height_vector[k]) for k in range(3)]
+            if 0 <= z < duration and 0 <= x < width and 0 <= y < height:
+                image[i, j] = frames[z][y, x]
+    return cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
+
+
+# Reference implementation of an animation, built from the same per-pixel algorithm
+def reference_animation(frames, width, height, duration, points_start, points_end, resolutions, num_steps):
+    scaling_factors = [width / 100, height / 100, duration / 100]
+    start = [[point[i] * scaling_factors[i] for i in range(3)] for point in points_start]
+    end = [[point[i] * scaling_factors[i] for i in range(3)] for point in points_end]
+    width_res = int(resolutions[0] * width / 100)
+    height_res = int(resolutions[1] * height / 100)
+    images = []
+    for step in range(num_steps):
+        t = step / (num_steps - 1)
+        p1, p2, p3 = [[a[i] * (1 - t) + b[i] * t for i in range(3)] for a, b in zip(start, end)]
+        images.append(_reference_plane(frames, width, height, duration, p1, p2, p3, width_res, height_res))
+    return images
+
+
+# Time `repeat` calls of `function`, hiding whatever it prints
+def _time(function, repeat):
+    times = []
+    for _ in range(repeat):
+        with contextlib.redirect_stdout(io.StringIO()):
+            start = time.perf_counter()
+            function()
+            times.append(time.perf_counter() - start)
+    return times
+
+
+def _load_png(path):
+    return np.array(Image.open(path).convert('RGB'))
+
+
+def run_benchmarks(fixtures, work_dir, repeat=3, num_steps=10, check=True):
+    # Keep the benchmark's decoded volumes out of the user's real cache
+    os.environ['TIMECUBE_CACHE_DIR'] = os.path.join(work_dir, 'volume_cache')
+    import takeVideoCrossSection as slicer
+    import video_volume_cache
+    from randomizePlyFilePoints import shuffle_ply_file
+    from video_to_ply import video_to_ply
+
+    results = []
+
+    def record(name, fixture, times, **details):
+        result = dict(name=name, video=fixture, seconds=times, min=min(times), median=statistics.median(times),
+                      **details)
+        results.append(result)
+        identical = result.get('identical')
+        print(f"{name:28} {fixture:8} {details.get('orientation', ''):14} {str(details.get('resolution', '')):>4} "
+              f"{details.get('cache', ''):5} {result['median'] * 1000:9.1f} ms"
+              + ('' if identical is None else ('  identical' if identical else '  MISMATCH')))
+
+    for fixture in fixtures:
+        width, height, frames = FIXTURES[fixture]
+        video_path = make_fixture(work_dir, fixture, width, height, frames)
+        reference_frames = _decode_all(video_path) if check else None
+        duration = len(reference_frames) if check else frames
+        output_name = os.path.join(work_dir, 'cross_section.png')
+
+        for orientation, points in ORIENTATIONS.items():
+            for resolution in RESOLUTIONS:
+                resolutions = [resolution, resolution]
+                expected = None
+                if check:
+                    expected = reference_cross_section(reference_frames, width, height, duration, points, resolutions)
+                for cache in ('off', 'warm'):
+                    use_cache = cache == 'warm'
+                    if use_cache:
+                        # Make sure the volume is cached before timing
+                        video_volume_cache.load_volume(os.path.abspath(video_path), wait_for_repeat=False)
+                    times = _time(lambda: slicer.create_cross_section(video_path, copy.deepcopy(points), resolutions,
+                                                                      output_name, use_cache), repeat)
+                    identical = None if expected is None else bool(np.array_equal(_load_png(output_name), expected))
+                    record('create_cross_section', fixture, times, orientation=orientation, resolution=resolution,
+                           cache=cache, identical=identical)
+
+        animation_dir = os.path.join(work_dir, f'animation_{fixture}')
+        os.makedirs(animation_dir, exist_ok=True)
+        for orientation, (points_start, points_end) in ANIMATIONS.items():
+            resolutions = [50, 50]
+            expected = None
+            if check:
+                expected = reference_animation(reference_frames, width, height, duration, points_start, points_end,
+                                               resolutions, num_steps)
+            for name in ('create_animation', 'create_animation_optimized'):
+                function = getattr(slicer, name)
+                base_name = os.path.join(animation_dir, 'frame')
+                times = _time(lambda: function(video_path, copy.deepcopy(points_start), copy.deepcopy(points_end),
+                                               resolutions, num_steps, base_name, False), repeat)
+                identical = None
+                if expected is not None:
+                    identical = all(np.array_equal(_load_png(f'{base_name}_{step}.png'), expected[step])
+                                    for step in range(num_steps))
+                record(name, fixture, times, orientation=orientation, resolution=resolutions[0], cache='off',
+                       identical=identical, steps=num_steps)
+
+        output_video = os.path.join(work_dir, f'animation_{fixture}.mp4')
+        times = _time(lambda: slicer.images_to_video(animation_dir, output_video, 15), repeat)
+        record('images_to_video', fixture, times, frames=num_steps)
+
+        ply_path = os.path.join(work_dir, f'{fixture}.ply')
+        _time(lambda: video_to_ply(video_path, ply_path, scale=0.25), 1)
+        times = _time(lambda: shuffle_ply_file(ply_path, ply_path + '.shuffled', seed=0), repeat)
+        record('shuffle_ply_file', fixture, times, size=os.path.getsize(ply_path))
+
+    return results
+
+
+def _result_key(result):
+    return tuple(str(result.get(field)) for field in ('name', 'video', 'orientation', 'resolution', 'cache'))
+
+
+# Print how each result compares to the same benchmark in a baseline run, returning the number of regressions
+# (benchmarks more than `tolerance` slower than the baseline, or no longer pixel-identical)
+def compare_to_baseline(results, baseline, tolerance=0.2):
+    baseline_results = {_result_key(result): result for result in baseline['results']}
+    regressions = 0
+    for result in results:
+        old = baseline_results.get(_result_key(result))
+        if old is None:
+            continue
+        ratio = result['median'] / old['median'] if old['median'] else float('inf')
+        regressed = ratio > 1 + tolerance or (old.get('identical') and result.get('identical') is False)
+        regressions += bool(regressed)
+        print(f"{' '.join(key for key in _result_key(result) if key != 'None'):60} {ratio:6.2f}x baseline"
+              + ('  REGRESSION' if regressed else ''))
+    return regressions
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Benchmark the TIMECUBE slicing pipeline.')
+    parser.add_argument('--fixtures', default='small,medium', help=f"comma-separated, from: {', '.join(FIXTURES)}")
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--steps', type=int, default=10, help='number of animation steps')
+    parser.add_argument('--work-dir', help='where to keep fixtures and outputs (defaults to a temporary folder)')
+    parser.add_argument('--output', help='write results to this JSON file')
+    parser.add_argument('--baseline', help='compare against the results in this JSON file')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='allowed slowdown before flagging a regression')
+    parser.add_argument('--no-check', action='store_true', help="skip the pixel-identical checks")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        work_dir = os.path.abspath(args.work_dir or temp_dir)
+        os.makedirs(work_dir, exist_ok=True)
+        results = run_benchmarks(args.fixtures.split(','), work_dir, args.repeat, args.steps, not args.no_check)
+
+    report = {
+        'meta': {
+            'timestamp': datetime.datetime.now().isoformat(timespec='seconds'),
+            'python': platform.python_version(),
+            'numpy': np.__version__,
+            'opencv': cv2.__version__,
+            'platform': platform.platform(),
+            'cpus': os.cpu_count(),
+        },
+        'results': results,
+    }
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+        print('Results written to', args.output)
+
+    failures = sum(result.get('identical') is False for result in results)
+    if args.baseline:
+        with open(args.baseline) as f:
+            failures += compare_to_baseline(results, json.load(f), args.tolerance)
+    sys.exit(1 if failures else 0)
@@ -0,0 +1,278 @@
+# Reader and writer for bricked `.tcbricks` volumes, which store a video as small compressed 3D bricks (32x32x32
+# pixels/frames by default) instead of whole frames, so that slicing an oblique TIMEKNIFE plane only has to read and
+# decompress the bricks the plane passes through. Reads then scale with the plane's area instead of with the number of
+# frames it spans times their full size.
+#
+# The file is a `.timecube` container (see `timecube_format.py`) with magic `TCBRICKS`, version 1 and footer magic
+# `TCBF`:
+#     bricks    zlib-compressed bricks, each holding raw `(frames, height, width, 3)` uint8 BGR pixels. Bricks are
+#               `brick_size` long along every axis, except at the far edges of the volume where they are cut short.
+#               They are stored frame-range first, then row, then column.
+#     metadata  `.timecube` metadata, plus brick_size
+#     index     one 28-byte entry per brick, in file order: uint32 brick t/y/x (position in the brick grid),
+#               uint64 offset of the compressed brick from the start of the file, uint64 compressed size
+#
+# `BrickVolumeReader` can be used anywhere the slicing code expects a decoded volume: `reader[frame_index]` returns a
+# lazy view of a frame, and indexing that view with pixel coordinates (`frame[ys, xs]`) only loads the bricks holding
+# those pixels. Decompressed bricks are kept in an LRU with a memory budget.
+# The bricks a plane needs can also be worked out up front, analytically from its corners (see `plane_bricks`). Once
+# the planes about to be sliced are known (`plan_planes`), the first request for a frame in each run of `brick_size`
+# frames loads all of that run's planned bricks in a single pass through the file.
+#
+# Run this file directly to convert a video:
+#     python brick_volume.py "../dist/timecube_models/man walking to bench.mp4" "man walking to bench.tcbricks"
+import os
+import threading
+import zlib
+from collections import OrderedDict
+
+import cv2
+import numpy as np
+
+from timecube_format import (check_frame, conversion_argument_parser, create_container, open_source_video,
+                             read_container, volume_metadata, write_trailer, write_video_frames)
+
+MAGIC = b'TCBRICKS'
+FOOTER_MAGIC = b'TCBF'
+VERSION = 1
+INDEX_DTYPE = np.dtype([('t', '<u4'), ('y', '<u4'), ('x', '<u4'), ('offset', '<u8'), ('size', '<u8')])
+DEFAULT_BRICK_SIZE = 32
+DEFAULT_CACHE_MB = 512
+
+
+# Streams frames into a new .tcbricks file, like `TimecubeWriter`. `brick_size` frames are buffered at a time, then cut
+# into bricks.
+class BrickVolumeWriter:
+    def __init__(self, path, width, height, fps=0, brick_size=DEFAULT_BRICK_SIZE, compression_level=1, source=None):
+        self.path = path
+        self.width = width
+        self.height = height
+        self.fps = fps
+        self.brick_size = brick_size
+        self.compression_level = compression_level
+        self.source = source or {}
+        self.num_frames = 0
+        self._index = []
+        self._pending = []
+        self._file = create_container(path, MAGIC, VERSION)
+
+    def write_frame(self, frame):
+        check_frame(frame, self.width, self.height)
+        self._pending.append(frame)
+        if len(self._pending) == self.brick_size:
+            self._flush()
+
+    def _flush(self):
+        if not self._pending:
+            return
+        frames = np.stack(self._pending)
+        size = self.brick_size
+        brick_t = self.num_frames // size
+        for brick_y, y in enumerate(range(0, self.height, size)):
+            for brick_x, x in enumerate(range(0, self.width, size)):
+                brick = np.ascontiguousarray(frames[:, y:y + size, x:x + size])
+                data = zlib.compress(brick.tobytes(), self.compression_level)
+                self._index.append((brick_t, brick_y, brick_x, self._file.tell(), len(data)))
+                self._file.write(data)
+        self.num_frames += len(self._pending)
+        self._pending = []
+
+    @property
+    def num_bricks(self):
+        return len(self._index)
+
+    def close(self):
+        if self._file.closed:
+            return
+        self._flush()
+        metadata = volume_metadata(self.width, self.height, self.num_frames, self.fps, self.source,
+                                   brick_size=self.brick_size)
+        write_trailer(self._file, metadata, self._index, INDEX_DTYPE, FOOTER_MAGIC)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+# Lazy view of one frame of a `BrickVolumeReader`. Only supports what the slicing code needs: gathering pixels with
+# `frame[ys, xs]`, which returns an `(n, 3)` array.
+class BrickFrame:
+    def __init__(self, reader, frame_index):
+        self.reader = reader
+        self.frame_index = frame_index
+        self.shape = reader.shape[1:]
+        self.dtype = np.dtype(np.uint8)
+
+    def __getitem__(self, key):
+        ys, xs = key
+        return self.reader.gather(self.frame_index, np.asarray(ys), np.asarray(xs))
+
+
+# Read-only access to a .tcbricks file. Bricks are loaded on demand, and the most recently used ones are kept in memory
+# up to `cache_bytes`. Brick loads are thread-safe, so frames can be requested from a prefetching thread (see
+# `frame_prefetch.py`) while the calling thread gathers pixels.
+class BrickVolumeReader:
+    def __init__(self, path, cache_bytes=DEFAULT_CACHE_MB * 1024 * 1024):
+        self.path = path
+        self._file = open(path, 'rb')
+        self.metadata, index = read_container(self._file, path, MAGIC, FOOTER_MAGIC, VERSION, INDEX_DTYPE, '.tcbricks')
+
+        self.shape = (self.metadata['frames'], self.metadata['height'], self.metadata['width'], 3)
+        self.fps = self.metadata['fps']
+        self.brick_size = self.metadata['brick_size']
+        self.grid = tuple(-(-n // self.brick_size) for n in self.shape[:3])
+        # Offset and size of every brick, by its linear id (see `brick_id`)
+        ids = self.brick_id(index['t'].astype(np.int64), index['y'].astype(np.int64), index['x'].astype(np.int64))
+        self._offsets = np.zeros(int(np.prod(self.grid)), dtype=np.int64)
+        self._sizes = np.zeros(int(np.prod(self.grid)), dtype=np.int64)
+        self._offsets[ids] = index['offset']
+        self._sizes[ids] = index['size']
+
+        self.cache_bytes = cache_bytes
+        self._bricks = OrderedDict()
+        self._cached_bytes = 0
+        self._lock = threading.Lock()
+        # Brick time slab -> ids of the bricks planned for it (see `plan_planes`)
+        self._planned = {}
+        self.bricks_read = 0
+
+    def __len__(self):
+        return self.shape[0]
+
+    def brick_id(self, brick_t, brick_y, brick_x):
+        return (brick_t * self.grid[1] + brick_y) * self.grid[2] + brick_x
+
+    def _read_brick(self, brick):
+        brick_t, rest = divmod(int(brick), self.grid[1] * self.grid[2])
+        brick_y, brick_x = divmod(rest, self.grid[2])
+        size = self.brick_size
+        shape = (min(size, self.shape[0] - brick_t * size), min(size, self.shape[1] - brick_y * size),
+                 min(size, self.shape[2] - brick_x * size), 3)
+        self._file.seek(int(self._offsets[brick]))
+        data = zlib.decompress(self._file.read(int(self._sizes[brick])))
+        self.bricks_read += 1
+        return np.frombuffer(data, dtype=np.uint8).reshape(shape)
+
+    # Decompressed brick with linear id `brick`, from the LRU if possible
+    def read_brick(self, brick):
+        with self._lock:
+            cached = self._bricks.get(brick)
+            if cached is not None:
+                self._bricks.move_to_end(brick)
+                return cached
+            data = self._read_brick(brick)
+            self._bricks[brick] = data
+            self._cached_bytes += data.nbytes
+            while self._cached_bytes > self.cache_bytes and len(self._bricks) > 1:
+                _, old = self._bricks.popitem(last=False)
+                self._cached_bytes -= old.nbytes
+            return data
+
+    # Load several bricks in file order, so the reads go through the file in a single pass
+    def read_bricks(self, bricks):
+        for brick in sorted(bricks, key=lambda brick: self._offsets[brick]):
+            self.read_brick(brick)
+
+    # Linear ids of the bricks that the plane with (video-space) corners `p1` (top left), `p2` (top right) and `p3`
+    # (bottom left) might sample from. Samples are rounded to the nearest pixel/frame, so a brick is needed if the
+    # parallelogram passes within half a pixel of it: each brick's box is grown by 0.5 on every side, and tested
+    # against the parallelogram's bounding box and against its plane (the box straddles the plane when the plane's
+    # distance from the box's center is at most the box's extent along the normal).
+    def plane_bricks(self, p1, p2, p3):
+        p1, p2, p3 = (np.asarray(p, dtype=np.float64) for p in (p1, p2, p3))
+        corners = np.array([p1, p2, p3, p2 + p3 - p1])
+        # Volume axes are (t, y, x), points are (x, y, t)
+        low = np.floor((corners.min(axis=0) - 0.5) / self.brick_size).astype(np.int64)
+        high = np.floor((corners.max(axis=0) + 0.5) / self.brick_size).astype(np.int64)
+        limits = np.array([self.grid[2], self.grid[1], self.grid[0]]) - 1
+        low, high = np.maximum(low, 0), np.minimum(high, limits)
+        if np.any(low > high):
+            return np.zeros(0, dtype=np.int64)
+
+        brick_x, brick_y, brick_t = np.meshgrid(*(np.arange(l, h + 1) for l, h in zip(low, high)), indexing='ij')
+        boxes = np.stack([brick_x.ravel(), brick_y.ravel(), brick_t.ravel()], axis=1)
+        box_low = boxes * self.brick_size - 0.5
+        box_high = np.minimum(box_low + self.brick_size, np.array([self.shape[2], self.shape[1], self.shape[0]]) - 0.5)
+
+        normal = np.cross(p2 - p1, p3 - p1)
+        if np.any(normal):
+            centers = (box_low + box_high) / 2
+            extents = (box_high - box_low) / 2
+            straddles = np.abs((centers - p1) @ normal) <= extents @ np.abs(normal)
+            boxes = boxes[straddles]
+        return np.sort(self.brick_id(boxes[:, 2], boxes[:, 1], boxes[:, 0]))
+
+    # Plan which bricks the given planes (an iterable of video-space `(p1, p2, p3)` corners) need, so that each run of
+    # `brick_size` frames can be loaded in one pass when it's first read
+    def plan_planes(self, planes):
+        bricks = np.unique(np.concatenate([self.plane_bricks(*corners) for corners in planes] or [[]]))
+        slabs = bricks.astype(np.int64) // (self.grid[1] * self.grid[2])
+        self._planned = {int(slab): bricks[slabs == slab].astype(np.int64) for slab in np.unique(slabs)}
+
+    def __getitem__(self, frame_index):
+        frame_index = int(frame_index)
+        if frame_index < 0 or frame_index >= self.shape[0]:
+            raise IndexError(f'Frame {frame_index} is outside of the volume (0-{self.shape[0] - 1})')
+        planned = self._planned.pop(frame_index // self.brick_size, None)
+        # (Unless they wouldn't all fit in the cache, in which case they're just loaded as they're needed)
+        if planned is not None and planned.size * self.brick_size ** 3 * 3 <= self.cache_bytes // 2:
+            self.read_bricks(planned)
+        return BrickFrame(self, frame_index)
+
+    # Pixels `(ys, xs)` of frame `frame_index` as an `(n, 3)` array, loading only the bricks that hold them
+    def gather(self, frame_index, ys, xs):
+        size = self.brick_size
+        brick_t, t = divmod(frame_index, size)
+        bricks = self.brick_id(brick_t, ys // size, xs // size)
+        values = np.empty((ys.size, 3), dtype=np.uint8)
+        order = np.argsort(bricks, kind='stable')
+        unique_bricks, starts = np.unique(bricks[order], return_index=True)
+        ends = np.append(starts[1:], order.size)
+        for brick, start, end in zip(unique_bricks, starts, ends):
+            samples = order[start:end]
+            values[samples] = self.read_brick(brick)[t, ys[samples] % size, xs[samples] % size]
+        return values
+
+    # Read frame `frame_index` in full, as a `(height, width, 3)` array
+    def read_frame(self, frame_index):
+        ys, xs = np.indices(self.shape[1:3]).reshape(2, -1)
+        return self[frame_index][ys, xs].reshape(self.shape[1:])
+
+    def close(self):
+        with self._lock:
+            self._bricks.clear()
+            self._cached_bytes = 0
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def video_to_bricks(video_path, output_path, width=None, height=None, scale=None, brick_size=DEFAULT_BRICK_SIZE,
+                    compression_level=1):
+    cap, size, source = open_source_video(video_path, width, height, scale)
+    try:
+        with BrickVolumeWriter(output_path, size[0], size[1], cap.get(cv2.CAP_PROP_FPS), brick_size,
+                               compression_level, source) as writer:
+            write_video_frames(cap, writer, size)
+    finally:
+        cap.release()
+
+    print(f'Wrote {writer.num_frames} frames ({size[0]}x{size[1]}) to {output_path} in {writer.num_bricks} bricks')
+    return output_path
+
+
+if __name__ == "__main__":
+    parser = conversion_argument_parser('Convert a video into a bricked .tcbricks volume.')
+    parser.add_argument('--brick-size', type=int, default=DEFAULT_BRICK_SIZE,
+                        help='length of every brick along x, y and time')
+    parser.add_argument('--compression-level', type=int, default=1, help='zlib compression level (0-9)')
+    args = parser.parse_args()
+
+    video_to_bricks(args.video_path, args.output_path or os.path.splitext(args.video_path)[0] + '.tcbricks',
+                    args.width, args.height, args.scale, args.brick_size, args.compression_level)
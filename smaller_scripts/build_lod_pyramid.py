@@ -0,0 +1,183 @@
+# Builds a level-of-detail pyramid of a TIMECUBE point cloud, so a viewer can show a coarse version of the cloud right
+# away and then refine it, instead of loading one full-resolution cloud up front.
+#     Each level is a separate binary .ply file, from coarsest (level 0) to finest, and each level has its own point
+#     budget.
+#     From a video (or .timecube file), level `k` keeps every `f`th frame and shrinks every kept frame by `f` along x
+#     and y (area-averaging the pixels it merges), with the smallest whole factor `f` that fits the level's budget.
+#     Points are placed in the full-resolution cloud's coordinate space (`[x, y - 1, frame]`, like `resizeAndPlyify.js`)
+#     so every level lines up with every other one. Levels can also be split into tiles of consecutive frames, so that a
+#     viewer can refine just the part of the cube around the camera or the TIMEKNIFE plane.
+#     From an existing .ply file, each level is a random subset of the points that fits its budget. The subsets are
+#     nested (every point of a coarse level is also in the finer ones), so a viewer can add finer levels on top of
+#     coarser ones without drawing any point twice.
+#     A `<name>_lod.json` manifest lists every level with its point count, spacing, tiles and files.
+#
+# Everything is streamed, one frame (or chunk of points) at a time, so clips far larger than RAM can be processed.
+#
+# Example:
+#     python build_lod_pyramid.py "../dist/timecube_models/man walking to bench.mp4" --budgets 50000,500000,5000000
+import argparse
+import json
+import math
+import os
+
+import cv2
+import numpy as np
+
+from ply_io import PlyWriter, iter_ply_vertices, read_ply_header, to_timecube_vertices
+from timecube_format import TimecubeReader
+from video_capture import open_capture
+from video_to_ply import frame_to_vertices, iter_video_frames, vertex_grid
+
+DEFAULT_BUDGETS = [100_000, 1_000_000, 10_000_000]
+
+
+# Smallest whole factor `f` such that keeping every `f`th frame and shrinking frames by `f` along x and y leaves at most
+# `budget` points
+def level_factor(width, height, frames, budget):
+    factor = 1
+    while math.ceil(width / factor) * math.ceil(height / factor) * math.ceil(frames / factor) > budget:
+        factor += 1
+    return factor
+
+
+# Opens one level's output files lazily, starting a new tile every `tile_frames` source frames
+class _LevelTiles:
+    def __init__(self, base_path, level, factor, tile_frames, binary):
+        self.base_path = base_path
+        self.level = level
+        self.factor = factor
+        self.tile_frames = tile_frames
+        self.binary = binary
+        self.tiles = []
+        self._writer = None
+        self._tile = None
+
+    def writer_for(self, frame_index):
+        tile = frame_index // self.tile_frames if self.tile_frames else 0
+        if tile != self._tile:
+            self.close()
+            suffix = f'_lod{self.level}' + (f'_tile{tile}' if self.tile_frames else '')
+            path = self.base_path + suffix + '.ply'
+            self._writer = PlyWriter(path, self.binary)
+            self._tile = tile
+            first_frame = tile * self.tile_frames if self.tile_frames else 0
+            self.tiles.append({'file': os.path.basename(path), 'first_frame': first_frame,
+                               'last_frame': first_frame + self.tile_frames - 1 if self.tile_frames else None})
+        return self._writer
+
+    def close(self):
+        if self._writer is not None:
+            self._writer.close()
+            self.tiles[-1]['points'] = self._writer.num_vertices
+            self._writer = None
+
+    @property
+    def points(self):
+        return sum(tile.get('points', 0) for tile in self.tiles)
+
+
+def _frame_source(video_path):
+    if video_path.lower().endswith('.timecube'):
+        reader = TimecubeReader(video_path)
+        frames, height, width = reader.shape[:3]
+        frame_pairs = ((frame_index, reader[frame_index]) for frame_index in range(frames))
+        return frame_pairs, width, height, frames, reader.close
+    cap = open_capture(video_path)
+    width = int(cap.get(cv2.CAP_PROP_FRAME_WIDTH))
+    height = int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
+    frames = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
+    return iter_video_frames(cap), width, height, frames, cap.release
+
+
+def pyramid_from_video(video_path, base_path, budgets=DEFAULT_BUDGETS, tile_frames=None, binary=True):
+    frames, width, height, num_frames, close = _frame_source(video_path)
+    factors = [level_factor(width, height, num_frames, budget) for budget in budgets]
+    levels = [_LevelTiles(base_path, level, factor, tile_frames, binary) for level, factor in enumerate(factors)]
+    grids = {}
+    try:
+        for frame_index, frame in frames:
+            for level in levels:
+                factor = level.factor
+                if frame_index % factor:
+                    continue
+                size = (math.ceil(width / factor), math.ceil(height / factor))
+                if factor > 1:
+                    frame_for_level = cv2.resize(frame, size, interpolation=cv2.INTER_AREA)
+                else:
+                    frame_for_level = frame
+                # Grid of points for this level, spread out over the full-resolution coordinate space
+                if factor not in grids:
+                    grid = vertex_grid(*size)
+                    grid['x'] *= factor
+                    grid['y'] = (grid['y'] + 1) * factor - 1
+                    grids[factor] = grid
+                vertices = frame_to_vertices(frame_for_level, frame_index, grids[factor])
+                level.writer_for(frame_index).write(vertices)
+    finally:
+        for level in levels:
+            level.close()
+        close()
+
+    return _write_manifest(base_path, video_path, levels, budgets,
+                           {'width': width, 'height': height, 'frames': num_frames})
+
+
+def pyramid_from_ply(ply_path, base_path, budgets=DEFAULT_BUDGETS, seed=0, binary=True, chunk_size=1 << 20):
+    with open(ply_path, 'rb') as f:
+        total = read_ply_header(f).vertex_count
+    levels = [_LevelTiles(base_path, level, None, None, binary) for level in range(len(budgets))]
+    # One random number per point decides which levels it is in, which is what makes the levels nested
+    keep_fractions = [min(1.0, budget / max(total, 1)) for budget in budgets]
+    rng = np.random.default_rng(seed)
+    try:
+        for chunk in iter_ply_vertices(ply_path, chunk_size):
+            vertices = to_timecube_vertices(chunk)
+            draws = rng.random(vertices.size)
+            for level, keep_fraction in zip(levels, keep_fractions):
+                level.writer_for(0).write(vertices[draws < keep_fraction])
+    finally:
+        for level in levels:
+            level.close()
+
+    return _write_manifest(base_path, ply_path, levels, budgets, {'points': total})
+
+
+def _write_manifest(base_path, source_path, levels, budgets, source):
+    manifest = {
+        'source': dict(source, path=os.path.abspath(source_path)),
+        'levels': [{
+            'level': level.level,
+            'budget': budget,
+            'points': level.points,
+            # Distance between neighbouring points (in source pixels/frames), handy for picking a point size
+            'spacing': level.factor,
+            'tiles': level.tiles,
+        } for level, budget in zip(levels, budgets)],
+    }
+    manifest_path = base_path + '_lod.json'
+    with open(manifest_path, 'w') as f:
+        json.dump(manifest, f, indent=2)
+    for level in manifest['levels']:
+        print(f"Level {level['level']}: {level['points']} points in {len(level['tiles'])} file(s)")
+    return manifest_path
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Build a level-of-detail pyramid of a TIMECUBE point cloud.')
+    parser.add_argument('input_path', help='a video, .timecube or .ply file')
+    parser.add_argument('output_base', nargs='?', help='path prefix for the output files (defaults to the input path)')
+    parser.add_argument('--budgets', default=','.join(str(budget) for budget in DEFAULT_BUDGETS),
+                        help='comma-separated point budget of each level, coarsest first')
+    parser.add_argument('--tile-frames', type=int,
+                        help='split each level into tiles of this many frames (video input only)')
+    parser.add_argument('--seed', type=int, default=0, help='random seed for subsampling .ply input')
+    parser.add_argument('--ascii', action='store_true', help='write ASCII .ply files instead of binary_little_endian')
+    args = parser.parse_args()
+
+    budgets = [int(budget) for budget in args.budgets.split(',')]
+    output_base = args.output_base or os.path.splitext(args.input_path)[0]
+    if args.input_path.lower().endswith('.ply'):
+        pyramid_from_ply(args.input_path, output_base, budgets, args.seed, binary=not args.ascii)
+    else:
+        pyramid_from_video(args.input_path, output_base, budgets, args.tile_frames, binary=not args.ascii)
@@ -0,0 +1,6 @@
+# The scripts in this folder import each other by bare module name, as they are run from here. This folder is also a
+# package, though, so pytest run from the repository root would only put the root on `sys.path`; add this folder too.
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
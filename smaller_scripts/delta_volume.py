@@ -0,0 +1,268 @@
+# Reader and writer for delta-encoded `.tcdelta` volumes, for videos shot with a static camera (like "man walking to
+# bench" or "clown blinking"), where most pixels barely change from one frame to the next.
+#     Every so often a whole frame is stored as a keyframe. Every other frame only stores the pixels that differ from
+#     its keyframe by more than `tolerance` (in any channel), as a sorted list of pixel positions and their colors.
+#     With a tolerance of 0 (the default) the volume is lossless; with a higher tolerance every pixel is within
+#     `tolerance` of its true value, since deltas are taken against the keyframe rather than against the previous frame.
+#     A new keyframe is started every `keyframe_interval` frames, or sooner once a frame differs from its keyframe in
+#     more than `max_delta_fraction` of its pixels (e.g. after a cut).
+#
+# The file is a `.timecube` container (see `timecube_format.py`) with magic `TCDELTAV`, version 1 and footer magic
+# `TCDF`:
+#     frames    one zlib-compressed record per frame. Keyframes hold raw `(height, width, 3)` uint8 BGR pixels. Other
+#               frames hold `count` uint32 gaps between consecutive changed pixel positions (`y * width + x`, the first
+#               gap counting from 0), followed by the `(count, 3)` uint8 BGR colors of those pixels.
+#     metadata  `.timecube` metadata, plus keyframe_interval, tolerance and max_delta_fraction
+#     index     one 24-byte entry per frame: uint32 frame number of its keyframe (its own number for keyframes),
+#               uint32 count of stored pixels (`width * height` for keyframes), uint64 offset of the compressed record
+#               from the start of the file, uint64 compressed size
+#
+# `DeltaVolumeReader` can be used anywhere the slicing code expects a decoded volume: `reader[frame_index]` returns a
+# lazy view of a frame, and indexing that view with pixel coordinates (`frame[ys, xs]`) reads the pixels from the
+# keyframe and patches in the frame's changed pixels, without ever building the full frame. Keyframes and deltas are
+# kept in an LRU with a memory budget, so all the frames between two keyframes share one decompressed keyframe.
+#
+# Run this file directly to convert a video:
+#     python delta_volume.py "../dist/timecube_models/man walking to bench.mp4" "man walking to bench.tcdelta"
+import os
+import threading
+import zlib
+from collections import OrderedDict
+
+import cv2
+import numpy as np
+
+from timecube_format import (check_frame, conversion_argument_parser, create_container, open_source_video,
+                             read_container, volume_metadata, write_trailer, write_video_frames)
+
+MAGIC = b'TCDELTAV'
+FOOTER_MAGIC = b'TCDF'
+VERSION = 1
+INDEX_DTYPE = np.dtype([('keyframe', '<u4'), ('count', '<u4'), ('offset', '<u8'), ('size', '<u8')])
+DEFAULT_KEYFRAME_INTERVAL = 30
+DEFAULT_MAX_DELTA_FRACTION = 0.25
+DEFAULT_CACHE_MB = 256
+
+
+# Flat positions (`y * width + x`) of the pixels of `frame` that differ from `reference` by more than `tolerance` in
+# any channel, in increasing order
+def changed_pixels(reference, frame, tolerance=0):
+    difference = np.abs(frame.astype(np.int16) - reference.astype(np.int16)).max(axis=2)
+    return np.flatnonzero(difference > tolerance)
+
+
+# Streams frames into a new .tcdelta file, like `TimecubeWriter`, deciding frame by frame whether to store a keyframe or
+# a delta.
+class DeltaVolumeWriter:
+    def __init__(self, path, width, height, fps=0, keyframe_interval=DEFAULT_KEYFRAME_INTERVAL, tolerance=0,
+                 max_delta_fraction=DEFAULT_MAX_DELTA_FRACTION, compression_level=1, source=None):
+        self.path = path
+        self.width = width
+        self.height = height
+        self.fps = fps
+        self.keyframe_interval = keyframe_interval
+        self.tolerance = tolerance
+        self.max_delta_fraction = max_delta_fraction
+        self.compression_level = compression_level
+        self.source = source or {}
+        self.num_frames = 0
+        self.num_keyframes = 0
+        self.num_delta_pixels = 0
+        self._index = []
+        self._keyframe = None
+        self._keyframe_index = 0
+        self._file = create_container(path, MAGIC, VERSION)
+
+    def write_frame(self, frame):
+        check_frame(frame, self.width, self.height)
+        positions = None
+        if self._keyframe is not None and self.num_frames - self._keyframe_index < self.keyframe_interval:
+            positions = changed_pixels(self._keyframe, frame, self.tolerance)
+            if positions.size > self.max_delta_fraction * self.width * self.height:
+                positions = None
+
+        if positions is None:
+            self._keyframe = np.ascontiguousarray(frame)
+            self._keyframe_index = self.num_frames
+            self.num_keyframes += 1
+            self._write_record(self._keyframe.tobytes(), self.width * self.height)
+        else:
+            gaps = np.diff(positions, prepend=0).astype('<u4')
+            colors = frame.reshape(-1, 3)[positions]
+            self.num_delta_pixels += positions.size
+            self._write_record(gaps.tobytes() + colors.tobytes(), positions.size)
+        self.num_frames += 1
+
+    def _write_record(self, data, count):
+        data = zlib.compress(data, self.compression_level)
+        self._index.append((self._keyframe_index, count, self._file.tell(), len(data)))
+        self._file.write(data)
+
+    def close(self):
+        if self._file.closed:
+            return
+        metadata = volume_metadata(self.width, self.height, self.num_frames, self.fps, self.source,
+                                   keyframe_interval=self.keyframe_interval, tolerance=self.tolerance,
+                                   max_delta_fraction=self.max_delta_fraction)
+        write_trailer(self._file, metadata, self._index, INDEX_DTYPE, FOOTER_MAGIC)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+# Lazy view of one frame of a `DeltaVolumeReader`: its keyframe, plus the positions and colors of the pixels that
+# differ from it. Gathering pixels with `frame[ys, xs]` returns an `(n, 3)` array; `np.asarray(frame)` builds the
+# whole `(height, width, 3)` frame.
+class DeltaFrame:
+    def __init__(self, keyframe, positions, colors):
+        self.keyframe = keyframe
+        self.positions = positions
+        self.colors = colors
+        self.shape = keyframe.shape
+        self.dtype = keyframe.dtype
+
+    def __getitem__(self, key):
+        ys, xs = (np.asarray(coordinates) for coordinates in key)
+        values = self.keyframe[ys, xs]
+        if self.positions.size:
+            wanted = ys.astype(np.int64) * self.shape[1] + xs
+            found = np.searchsorted(self.positions, wanted)
+            found[found == self.positions.size] = 0
+            hits = self.positions[found] == wanted
+            values[hits] = self.colors[found[hits]]
+        return values
+
+    def __array__(self, dtype=None, copy=None):
+        frame = self.keyframe.copy()
+        frame.reshape(-1, 3)[self.positions] = self.colors
+        return frame if dtype is None else frame.astype(dtype)
+
+
+# Read-only access to a .tcdelta file. Decompressed keyframes and deltas are kept in memory up to `cache_bytes`. Reads
+# are thread-safe, so frames can be requested from a prefetching thread (see `frame_prefetch.py`) while the calling
+# thread gathers pixels.
+class DeltaVolumeReader:
+    def __init__(self, path, cache_bytes=DEFAULT_CACHE_MB * 1024 * 1024):
+        self.path = path
+        self._file = open(path, 'rb')
+        self.metadata, self.index = read_container(self._file, path, MAGIC, FOOTER_MAGIC, VERSION, INDEX_DTYPE,
+                                                   '.tcdelta')
+
+        self.shape = (self.metadata['frames'], self.metadata['height'], self.metadata['width'], 3)
+        self.fps = self.metadata['fps']
+        self.tolerance = self.metadata['tolerance']
+        self.cache_bytes = cache_bytes
+        self._records = OrderedDict()
+        self._cached_bytes = 0
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return self.shape[0]
+
+    def is_keyframe(self, frame_index):
+        return self.index['keyframe'][frame_index] == frame_index
+
+    def _read_record(self, frame_index):
+        keyframe, count, offset, size = self.index[frame_index]
+        self._file.seek(int(offset))
+        data = zlib.decompress(self._file.read(int(size)))
+        if keyframe == frame_index:
+            return np.frombuffer(data, dtype=np.uint8).reshape(self.shape[1:])
+        count = int(count)
+        positions = np.cumsum(np.frombuffer(data, dtype='<u4', count=count), dtype=np.int64)
+        colors = np.frombuffer(data, dtype=np.uint8, offset=count * 4).reshape(count, 3)
+        return positions, colors
+
+    # Keyframe pixels for keyframes, or `(positions, colors)` for other frames
+    def read_record(self, frame_index):
+        with self._lock:
+            cached = self._records.get(frame_index)
+            if cached is not None:
+                self._records.move_to_end(frame_index)
+                return cached
+            record = self._read_record(frame_index)
+            size = record.nbytes if isinstance(record, np.ndarray) else record[0].nbytes + record[1].nbytes
+            self._records[frame_index] = record
+            self._cached_bytes += size
+            while self._cached_bytes > self.cache_bytes and len(self._records) > 2:
+                _, old = self._records.popitem(last=False)
+                self._cached_bytes -= old.nbytes if isinstance(old, np.ndarray) else old[0].nbytes + old[1].nbytes
+            return record
+
+    def __getitem__(self, frame_index):
+        frame_index = int(frame_index)
+        if frame_index < 0 or frame_index >= self.shape[0]:
+            raise IndexError(f'Frame {frame_index} is outside of the volume (0-{self.shape[0] - 1})')
+        keyframe = self.read_record(int(self.index['keyframe'][frame_index]))
+        if self.is_keyframe(frame_index):
+            return DeltaFrame(keyframe, np.zeros(0, dtype=np.int64), np.zeros((0, 3), dtype=np.uint8))
+        return DeltaFrame(keyframe, *self.read_record(frame_index))
+
+    def read_frame(self, frame_index):
+        return np.asarray(self[frame_index])
+
+    # Read frames `start` up to (not including) `stop` into one `(stop - start, height, width, 3)` array
+    def read_frames(self, start, stop):
+        start, stop = max(0, start), min(self.shape[0], stop)
+        frames = np.empty((max(0, stop - start),) + self.shape[1:], dtype=np.uint8)
+        for frame_index in range(start, stop):
+            frames[frame_index - start] = self.read_frame(frame_index)
+        return frames
+
+    def close(self):
+        with self._lock:
+            self._records.clear()
+            self._cached_bytes = 0
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+# Encode the frames `cap` still has to give into a .tcdelta file, returning the writer (closed) for its statistics
+def encode_capture(cap, output_path, size=None, keyframe_interval=DEFAULT_KEYFRAME_INTERVAL, tolerance=0,
+                   max_delta_fraction=DEFAULT_MAX_DELTA_FRACTION, compression_level=1, source=None):
+    width = size[0] if size else int(cap.get(cv2.CAP_PROP_FRAME_WIDTH))
+    height = size[1] if size else int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
+    with DeltaVolumeWriter(output_path, width, height, cap.get(cv2.CAP_PROP_FPS), keyframe_interval, tolerance,
+                           max_delta_fraction, compression_level, source) as writer:
+        write_video_frames(cap, writer, size)
+    return writer
+
+
+def video_to_delta_volume(video_path, output_path, width=None, height=None, scale=None,
+                          keyframe_interval=DEFAULT_KEYFRAME_INTERVAL, tolerance=0,
+                          max_delta_fraction=DEFAULT_MAX_DELTA_FRACTION, compression_level=1):
+    cap, size, source = open_source_video(video_path, width, height, scale)
+    try:
+        writer = encode_capture(cap, output_path, size, keyframe_interval, tolerance, max_delta_fraction,
+                                compression_level, source)
+    finally:
+        cap.release()
+
+    stored = writer.num_keyframes + writer.num_delta_pixels / (size[0] * size[1])
+    print(f'Wrote {writer.num_frames} frames ({size[0]}x{size[1]}) to {output_path}: {writer.num_keyframes} keyframes, '
+          f'{stored / max(1, writer.num_frames):.1%} of the pixels stored')
+    return output_path
+
+
+if __name__ == "__main__":
+    parser = conversion_argument_parser('Convert a video into a delta-encoded .tcdelta volume.')
+    parser.add_argument('--keyframe-interval', type=int, default=DEFAULT_KEYFRAME_INTERVAL,
+                        help='store a whole frame at least every N frames')
+    parser.add_argument('--tolerance', type=int, default=0,
+                        help='largest per-channel change (0-255) that is not stored; 0 is lossless')
+    parser.add_argument('--max-delta-fraction', type=float, default=DEFAULT_MAX_DELTA_FRACTION,
+                        help='start a new keyframe once more than this fraction of the pixels changed')
+    parser.add_argument('--compression-level', type=int, default=1, help='zlib compression level (0-9)')
+    args = parser.parse_args()
+
+    video_to_delta_volume(args.video_path, args.output_path or os.path.splitext(args.video_path)[0] + '.tcdelta',
+                          args.width, args.height, args.scale, args.keyframe_interval, args.tolerance,
+                          args.max_delta_fraction, args.compression_level)
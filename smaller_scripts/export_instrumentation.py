@@ -0,0 +1,207 @@
+# Lightweight instrumentation for exports: per-stage wall time and peak memory, counters (frames decoded vs skipped,
+# samples gathered, ...), and progress.
+# Everything is printed as one JSON object per line, so `main.js` can pick the lines out of the script's output:
+#     {"type": "stage", "stage": "decode", "seconds": 0.41, "peak_memory_bytes": 52428800}
+#     {"type": "progress", "stage": "decode", "done": 120, "total": 300}
+#     {"type": "summary", "seconds": 1.9, "stages": {...}, "counters": {...}, "peak_memory_bytes": ...}
+#
+# A stage's peak memory is the most memory Python and NumPy had allocated at any point during the stage (as tracked by
+# `tracemalloc`, including stages nested inside it), so memory-mapped volumes only count once pages are copied out of
+# them. The summary's `peak_memory_bytes` is the peak resident memory of the whole process so far, as reported by the
+# operating system.
+#
+# Tracing is off unless the `TIMECUBE_TRACE` environment variable is set to 1 (or `trace.enable()` is called), and when
+# it is off every hook returns straight away, so it can be left in hot code. While it is on, `tracemalloc` makes
+# allocations somewhat slower.
+import contextlib
+import json
+import os
+import sys
+import time
+import tracemalloc
+
+try:
+    import resource
+except ImportError:  # Not available on Windows
+    resource = None
+
+# Stages an export goes through, in order. Stages may be entered many times (e.g. once per frame); their times add up.
+STAGES = ('open', 'coordinates', 'index', 'decode', 'gather', 'color', 'encode')
+
+# Minimum time between two progress messages for the same stage
+PROGRESS_INTERVAL = 0.1
+
+_NULL_CONTEXT = contextlib.nullcontext()
+_END = object()
+
+
+def peak_memory_bytes():
+    if sys.platform == 'win32':
+        return _windows_peak_memory_bytes()
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS reports bytes
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+def _windows_peak_memory_bytes():
+    import ctypes
+    from ctypes import wintypes
+
+    class ProcessMemoryCounters(ctypes.Structure):
+        _fields_ = [('cb', wintypes.DWORD), ('PageFaultCount', wintypes.DWORD)] + \
+                   [(name, ctypes.c_size_t) for name in (
+                       'PeakWorkingSetSize', 'WorkingSetSize', 'QuotaPeakPagedPoolUsage', 'QuotaPagedPoolUsage',
+                       'QuotaPeakNonPagedPoolUsage', 'QuotaNonPagedPoolUsage', 'PagefileUsage', 'PeakPagefileUsage')]
+
+    counters = ProcessMemoryCounters()
+    counters.cb = ctypes.sizeof(counters)
+    get_current_process = ctypes.windll.kernel32.GetCurrentProcess
+    get_current_process.restype = wintypes.HANDLE
+    get_memory_info = ctypes.windll.psapi.GetProcessMemoryInfo
+    get_memory_info.argtypes = [wintypes.HANDLE, ctypes.POINTER(ProcessMemoryCounters), wintypes.DWORD]
+    if not get_memory_info(get_current_process(), ctypes.byref(counters), counters.cb):
+        return None
+    return counters.PeakWorkingSetSize
+
+
+class _Stage:
+    def __init__(self, trace, name, report):
+        self.trace = trace
+        self.name = name
+        self.report = report
+
+    def __enter__(self):
+        self.trace._enter_memory_stage(self)
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        seconds = time.perf_counter() - self.start
+        peak_memory = self.trace._exit_memory_stage(self)
+        self.trace.add_time(self.name, seconds, peak_memory)
+        if self.report:
+            self.trace.emit({'type': 'stage', 'stage': self.name, 'seconds': round(seconds, 6),
+                             'peak_memory_bytes': peak_memory})
+
+
+class ExportTrace:
+    def __init__(self, enabled=False):
+        self.enabled = False
+        self._started_tracemalloc = False
+        self.enable(enabled)
+        self.reset()
+
+    def enable(self, enabled=True):
+        self.enabled = enabled
+        if enabled and not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self._started_tracemalloc = True
+        elif not enabled and self._started_tracemalloc:
+            tracemalloc.stop()
+            self._started_tracemalloc = False
+
+    # Start a new export: clear all times, memory peaks and counters
+    def reset(self):
+        self.started = time.perf_counter()
+        self.stage_seconds = {}
+        self.stage_calls = {}
+        self.stage_peak_memory = {}
+        self.counters = {}
+        self._last_progress = {}
+        # Stages currently open, innermost last
+        self._open_stages = []
+
+    def emit(self, message):
+        print(json.dumps(message), flush=True)
+
+    # Context manager timing one stage. A `stage` message is printed when it ends.
+    def stage(self, name):
+        if not self.enabled:
+            return _NULL_CONTEXT
+        return _Stage(self, name, True)
+
+    # Like `stage`, but without printing anything, for stages entered once per frame or step
+    def accumulate(self, name):
+        if not self.enabled:
+            return _NULL_CONTEXT
+        return _Stage(self, name, False)
+
+    def add_time(self, name, seconds, peak_memory=None):
+        self.stage_seconds[name] = self.stage_seconds.get(name, 0) + seconds
+        self.stage_calls[name] = self.stage_calls.get(name, 0) + 1
+        if peak_memory is not None:
+            self.stage_peak_memory[name] = max(self.stage_peak_memory.get(name, 0), peak_memory)
+
+    # `tracemalloc` only keeps one peak for the whole process, so it is reset whenever a stage starts, after handing the
+    # peak so far to the enclosing stage. Allocations made by other threads (e.g. a frame prefetcher) count towards
+    # whichever stages are open at the time.
+    def _enter_memory_stage(self, stage):
+        stage.peak_memory = None
+        if not tracemalloc.is_tracing():
+            return
+        current, peak = tracemalloc.get_traced_memory()
+        if self._open_stages:
+            outer = self._open_stages[-1]
+            outer.peak_memory = max(outer.peak_memory, peak)
+        tracemalloc.reset_peak()
+        stage.peak_memory = current
+        self._open_stages.append(stage)
+
+    # Returns the peak memory of a stage that just ended, and hands it on to the enclosing stage
+    def _exit_memory_stage(self, stage):
+        if stage not in self._open_stages:
+            return None
+        self._open_stages.remove(stage)
+        if not tracemalloc.is_tracing():
+            return None
+        peak = max(stage.peak_memory, tracemalloc.get_traced_memory()[1])
+        if self._open_stages:
+            outer = self._open_stages[-1]
+            outer.peak_memory = max(outer.peak_memory, peak)
+        return peak
+
+    def count(self, name, amount=1):
+        if self.enabled:
+            self.counters[name] = self.counters.get(name, 0) + int(amount)
+
+    # Wrap an iterator so that the time spent producing each item is added to `name`
+    def timed(self, iterable, name):
+        if not self.enabled:
+            return iterable
+        return self._timed(iterable, name)
+
+    def _timed(self, iterable, name):
+        iterator = iter(iterable)
+        while True:
+            with _Stage(self, name, False):
+                item = next(iterator, _END)
+            if item is _END:
+                return
+            yield item
+
+    # Report that `done` out of `total` units of `stage` are finished (throttled, except for the final update)
+    def progress(self, stage, done, total):
+        if not self.enabled:
+            return
+        now = time.perf_counter()
+        if done < total and now - self._last_progress.get(stage, 0) < PROGRESS_INTERVAL:
+            return
+        self._last_progress[stage] = now
+        self.emit({'type': 'progress', 'stage': stage, 'done': int(done), 'total': int(total)})
+
+    def summary(self, **details):
+        if not self.enabled:
+            return
+        order = sorted(self.stage_seconds, key=lambda name: STAGES.index(name) if name in STAGES else len(STAGES))
+        stages = {name: {'seconds': round(self.stage_seconds[name], 6), 'calls': self.stage_calls[name],
+                         'peak_memory_bytes': self.stage_peak_memory.get(name)}
+                  for name in order}
+        self.emit(dict({'type': 'summary', 'seconds': round(time.perf_counter() - self.started, 6),
+                        'stages': stages, 'counters': self.counters, 'peak_memory_bytes': peak_memory_bytes()},
+                       **details))
+
+
+# Shared by everything in one process
+trace = ExportTrace(os.environ.get('TIMECUBE_TRACE', '0') == '1')
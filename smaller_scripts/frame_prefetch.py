@@ -0,0 +1,91 @@
+# Runs a frame iterator (decoding a video, loading images, ...) on a background thread, so the next frames are already
+# being decoded while the caller is still sampling the current one. cv2 releases the GIL while it decodes or loads an
+# image, so the two really do run at the same time.
+# At most `depth` frames wait in the queue, which bounds the extra memory to `depth` frames.
+#
+# Use as a context manager, so the thread is always stopped (and the underlying capture is free again) when the caller
+# is done, even if it stops early:
+#     with FramePrefetcher(read_needed_frames(cap, frame_indices)) as frames:
+#         for frame_index, frame in frames:
+#             ...
+import os
+import queue
+import threading
+
+# How many frames to decode ahead by default. Set the `TIMECUBE_PREFETCH_FRAMES` environment variable to change it,
+# or to 0 to decode on the calling thread like before.
+DEFAULT_DEPTH = 8
+
+_DONE = object()
+
+
+def prefetch_depth():
+    return max(0, int(os.environ.get('TIMECUBE_PREFETCH_FRAMES', DEFAULT_DEPTH)))
+
+
+class FramePrefetcher:
+    def __init__(self, iterable, depth=None):
+        self.depth = prefetch_depth() if depth is None else depth
+        self._iterator = iter(iterable)
+        self._finished = False
+        self._thread = None
+        if self.depth > 0:
+            self._queue = queue.Queue(maxsize=self.depth)
+            self._stop = threading.Event()
+            self._thread = threading.Thread(target=self._run, daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        try:
+            for item in self._iterator:
+                if not self._put((True, item)):
+                    return
+            self._put((True, _DONE))
+        except BaseException as e:
+            # Handed over to the consumer, which raises it from `__next__`
+            self._put((False, e))
+        finally:
+            close = getattr(self._iterator, 'close', None)
+            if close is not None:
+                close()
+
+    # Block until there's room in the queue, unless the consumer has stopped in the meantime
+    def _put(self, entry):
+        while not self._stop.is_set():
+            try:
+                self._queue.put(entry, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self._finished:
+            raise StopIteration
+        if self._thread is None:
+            return next(self._iterator)
+        ok, item = self._queue.get()
+        if not ok:
+            self._finished = True
+            raise item
+        if item is _DONE:
+            self._finished = True
+            raise StopIteration
+        return item
+
+    def close(self):
+        self._finished = True
+        if self._thread is not None:
+            self._stop.set()
+            self._thread.join()
+        elif hasattr(self._iterator, 'close'):
+            self._iterator.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
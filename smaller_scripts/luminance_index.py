@@ -0,0 +1,258 @@
+# Builds and queries a companion index for TIMECUBE point clouds that sorts the points by brightness and by each color
+# channel, so transparency filtering (e.g. the slicer's "Threshold" mode, which throws away the lighter or darker
+# points) can be done before the cloud is ever loaded, rather than by scanning every point in the viewer.
+#     For every key (`luma`, `red`, `green`, `blue`) the index holds the ids of all points sorted by that key's 8-bit
+#     value, plus the 257 offsets where each value's run starts and ends. Selecting the points within a range of values
+#     is then just two lookups, and gives back one contiguous run of point ids.
+#     `luma` follows the viewer's shaders: colors are gamma corrected (`pow(color, 1 / gamma)`, with the viewer's
+#     default gamma of 2.2) and weighted by (0.299, 0.587, 0.114).
+#     Point ids are the points' positions in the source: the vertex order of a .ply file, or
+#     `(frame * height + y) * width + x` for a `.timecube` volume (the order `video_to_ply.py` writes points in).
+#     The selected points can be written out as a new .ply file, or, for `.timecube` sources, as a `.timecube` volume
+#     where every other pixel is black.
+#
+# File layout (`.lumindex`, integers little-endian): magic `TCLUMIDX`, uint32 format version, uint64 length of the
+# metadata, the UTF-8 JSON metadata (padded with spaces to a multiple of 8 bytes), then for every key its 257 uint64
+# offsets followed by its sorted point ids. The metadata records where each key's arrays start, so they can be memory
+# mapped without reading the whole file.
+#
+# Examples:
+#     python luminance_index.py build timecube.ply
+#     python luminance_index.py select timecube.ply dark_points.ply --key luma --max 0.3
+import argparse
+import json
+import os
+import struct
+
+import numpy as np
+
+from ply_io import PlyWriter, iter_ply_vertices, to_timecube_vertices
+from timecube_format import TimecubeReader, TimecubeWriter
+from video_to_ply import frame_to_vertices, vertex_grid
+
+MAGIC = b'TCLUMIDX'
+VERSION = 1
+HEADER = struct.Struct('<8sIQ')
+KEYS = ('luma', 'red', 'green', 'blue')
+LUMA_WEIGHTS = (0.299, 0.587, 0.114)
+DEFAULT_GAMMA = 2.2
+
+
+def index_path_for(source_path):
+    return os.path.splitext(source_path)[0] + '.lumindex'
+
+
+# Lookup table from an 8-bit channel value to its gamma-corrected, luma-weighted contribution, per channel (r, g, b)
+def _luma_tables(gamma):
+    corrected = (np.arange(256) / 255) ** (1 / gamma)
+    return [corrected * weight for weight in LUMA_WEIGHTS]
+
+
+# 8-bit value of every key for RGB colors given as three uint8 arrays
+def key_values(red, green, blue, gamma=DEFAULT_GAMMA):
+    red_table, green_table, blue_table = _luma_tables(gamma)
+    luma = red_table[red] + green_table[green] + blue_table[blue]
+    return {
+        'luma': np.clip(np.rint(luma * 255), 0, 255).astype(np.uint8),
+        'red': red,
+        'green': green,
+        'blue': blue,
+    }
+
+
+# Yield the colors of every point in the source, in point id order, as `(first_id, red, green, blue)` chunks
+def _iter_colors(source_path, chunk_size=1 << 20):
+    if source_path.lower().endswith('.timecube'):
+        with TimecubeReader(source_path) as reader:
+            frames, height, width = reader.shape[:3]
+            for frame_index in range(frames):
+                frame = reader[frame_index].reshape(-1, 3)
+                yield frame_index * height * width, frame[:, 2], frame[:, 1], frame[:, 0]
+        return
+    first_id = 0
+    for chunk in iter_ply_vertices(source_path, chunk_size):
+        vertices = to_timecube_vertices(chunk)
+        yield first_id, vertices['red'], vertices['green'], vertices['blue']
+        first_id += vertices.size
+
+
+def build_index(source_path, index_path=None, gamma=DEFAULT_GAMMA, chunk_size=1 << 20):
+    index_path = index_path or index_path_for(source_path)
+
+    # First pass: count how many points have each value of each key
+    counts = {key: np.zeros(256, dtype=np.int64) for key in KEYS}
+    num_points = 0
+    for first_id, red, green, blue in _iter_colors(source_path, chunk_size):
+        for key, values in key_values(red, green, blue, gamma).items():
+            counts[key] += np.bincount(values, minlength=256)
+        num_points += red.size
+
+    id_dtype = np.dtype('<u4') if num_points < 2 ** 32 else np.dtype('<u8')
+    offsets = {key: np.concatenate([[0], np.cumsum(counts[key])]).astype('<u8') for key in KEYS}
+
+    # Lay out the file: metadata first, then each key's offsets and sorted ids
+    metadata = {'points': num_points, 'gamma': gamma, 'id_dtype': id_dtype.str, 'keys': {},
+                'source': {'path': os.path.abspath(source_path), **_source_identity(source_path)}}
+    if source_path.lower().endswith('.timecube'):
+        with TimecubeReader(source_path) as reader:
+            metadata['source']['shape'] = list(reader.shape[:3])
+    placeholder = json.dumps(dict(metadata, keys={key: {'offsets': 0, 'ids': 0} for key in KEYS})).encode('utf-8')
+    position = HEADER.size + len(placeholder) + 8 * len(KEYS) * 24  # room for the offsets' digits
+    position += -position % 8
+    for key in KEYS:
+        metadata['keys'][key] = {'offsets': position, 'ids': position + 257 * 8}
+        position += 257 * 8 + num_points * id_dtype.itemsize
+    metadata_bytes = json.dumps(metadata).encode('utf-8')
+    data_start = metadata['keys'][KEYS[0]]['offsets']
+    metadata_bytes += b' ' * (data_start - HEADER.size - len(metadata_bytes))
+
+    with open(index_path, 'wb') as f:
+        f.write(HEADER.pack(MAGIC, VERSION, len(metadata_bytes)))
+        f.write(metadata_bytes)
+        f.truncate(position)
+    index_file = np.memmap(index_path, dtype=np.uint8, mode='r+')
+    ids = {}
+    for key in KEYS:
+        start = metadata['keys'][key]['offsets']
+        index_file[start:start + 257 * 8] = np.frombuffer(offsets[key].tobytes(), dtype=np.uint8)
+        start = metadata['keys'][key]['ids']
+        ids[key] = index_file[start:start + num_points * id_dtype.itemsize].view(id_dtype)
+
+    # Second pass: counting sort, placing every point id right after the ids that came before it with the same value
+    cursors = {key: offsets[key][:-1].astype(np.int64) for key in KEYS}
+    for first_id, red, green, blue in _iter_colors(source_path, chunk_size):
+        for key, values in key_values(red, green, blue, gamma).items():
+            order = np.argsort(values, kind='stable')
+            chunk_counts = np.bincount(values, minlength=256)
+            chunk_starts = np.concatenate([[0], np.cumsum(chunk_counts)[:-1]])
+            sorted_values = values[order]
+            positions = cursors[key][sorted_values] + np.arange(order.size) - chunk_starts[sorted_values]
+            ids[key][positions] = first_id + order
+            cursors[key] += chunk_counts
+    index_file.flush()
+    del ids, index_file
+
+    print(f'Indexed {num_points} points of {source_path} into {index_path}')
+    return index_path
+
+
+# Read-only access to a .lumindex file; the sorted ids are memory mapped
+class LuminanceIndex:
+    def __init__(self, index_path):
+        self.path = index_path
+        with open(index_path, 'rb') as f:
+            magic, version, metadata_length = HEADER.unpack(f.read(HEADER.size))
+            if magic != MAGIC:
+                raise Exception(f"`{index_path}` is not a .lumindex file")
+            if version > VERSION:
+                raise Exception(f"`{index_path}` uses .lumindex format version {version}, which is newer than this "
+                                f"reader")
+            self.metadata = json.loads(f.read(metadata_length).decode('utf-8'))
+        self.points = self.metadata['points']
+        self.gamma = self.metadata['gamma']
+        id_dtype = np.dtype(self.metadata['id_dtype'])
+        self.offsets = {}
+        self.ids = {}
+        for key, positions in self.metadata['keys'].items():
+            self.offsets[key] = np.memmap(index_path, dtype='<u8', mode='r', offset=positions['offsets'],
+                                          shape=(257,)).astype(np.int64)
+            self.ids[key] = np.memmap(index_path, dtype=id_dtype, mode='r', offset=positions['ids'],
+                                      shape=(self.points,)) if self.points else np.zeros(0, dtype=id_dtype)
+
+    # Ids of the points whose `key` lies between `minimum` and `maximum` (inclusive, as fractions from 0 to 1 like the
+    # slicer's sliders), sorted by that key. This is a contiguous, memory-mapped run of the index.
+    def select(self, key, minimum=0.0, maximum=1.0):
+        if key not in self.ids:
+            raise Exception(f"Unknown key `{key}` (expected one of {KEYS})")
+        low = int(np.clip(np.ceil(minimum * 255 - 1e-9), 0, 256))
+        high = int(np.clip(np.floor(maximum * 255 + 1e-9), -1, 255))
+        if high < low:
+            return self.ids[key][:0]
+        return self.ids[key][self.offsets[key][low]:self.offsets[key][high + 1]]
+
+    # Number of points `select` would return, without touching the ids
+    def count(self, key, minimum=0.0, maximum=1.0):
+        return self.select(key, minimum, maximum).size
+
+    # Boolean mask over all point ids of the points `select` would return
+    def mask(self, key, minimum=0.0, maximum=1.0):
+        mask = np.zeros(self.points, dtype=bool)
+        mask[self.select(key, minimum, maximum)] = True
+        return mask
+
+
+# Write the points of `source_path` selected by `mask` (see `LuminanceIndex.mask`) to `output_path`: a .ply file, or a
+# .timecube volume with every unselected pixel black (for .timecube sources only). Points keep their original order.
+def write_selection(source_path, mask, output_path, binary=True, chunk_size=1 << 20):
+    from_volume = source_path.lower().endswith('.timecube')
+    if output_path.lower().endswith('.timecube'):
+        if not from_volume:
+            raise Exception("Only .timecube sources can be filtered into a .timecube volume")
+        with TimecubeReader(source_path) as reader, \
+                TimecubeWriter(output_path, reader.shape[2], reader.shape[1], reader.fps,
+                               source=reader.metadata.get('source')) as writer:
+            pixels = reader.shape[1] * reader.shape[2]
+            for frame_index in range(reader.shape[0]):
+                keep = mask[frame_index * pixels:(frame_index + 1) * pixels].reshape(reader.shape[1:3])
+                writer.write_frame(np.where(keep[..., np.newaxis], reader[frame_index], 0).astype(np.uint8))
+        return int(mask.sum())
+
+    with PlyWriter(output_path, binary) as writer:
+        if from_volume:
+            with TimecubeReader(source_path) as reader:
+                frames, height, width = reader.shape[:3]
+                grid = vertex_grid(width, height)
+                for frame_index in range(frames):
+                    keep = mask[frame_index * height * width:(frame_index + 1) * height * width]
+                    if keep.any():
+                        writer.write(frame_to_vertices(reader[frame_index], frame_index, grid)[keep])
+        else:
+            first_id = 0
+            for chunk in iter_ply_vertices(source_path, chunk_size):
+                vertices = to_timecube_vertices(chunk)
+                writer.write(vertices[mask[first_id:first_id + vertices.size]])
+                first_id += vertices.size
+    return writer.num_vertices
+
+
+# Size and modification time of the source, stored in its index so a stale index can be told apart from an up-to-date
+# one
+def _source_identity(source_path):
+    stat = os.stat(source_path)
+    return {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+
+
+# Filter `source_path` by one key, building its index first if there isn't an up-to-date one
+def select_points(source_path, output_path, key='luma', minimum=0.0, maximum=1.0, index_path=None, binary=True):
+    index_path = index_path or index_path_for(source_path)
+    index = LuminanceIndex(index_path) if os.path.isfile(index_path) else None
+    identity = _source_identity(source_path)
+    if index is None or any(index.metadata['source'].get(field) != value for field, value in identity.items()):
+        build_index(source_path, index_path)
+        index = LuminanceIndex(index_path)
+    written = write_selection(source_path, index.mask(key, minimum, maximum), output_path, binary)
+    print(f'Wrote {written} of {index.points} points to {output_path}')
+    return written
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Build or query a luminance/color index of a TIMECUBE point cloud.')
+    commands = parser.add_subparsers(dest='command', required=True)
+    build = commands.add_parser('build', help='index a .ply or .timecube file')
+    build.add_argument('source_path')
+    build.add_argument('index_path', nargs='?', help='defaults to the source path with a .lumindex extension')
+    build.add_argument('--gamma', type=float, default=DEFAULT_GAMMA)
+    select = commands.add_parser('select', help='write the points within a range of values to a new file')
+    select.add_argument('source_path')
+    select.add_argument('output_path', help='a .ply file (or a .timecube file, for .timecube sources)')
+    select.add_argument('--key', choices=KEYS, default='luma')
+    select.add_argument('--min', type=float, default=0.0, help='lowest value to keep, from 0 to 1')
+    select.add_argument('--max', type=float, default=1.0, help='highest value to keep, from 0 to 1')
+    select.add_argument('--index', help='index file (defaults to the source path with a .lumindex extension)')
+    select.add_argument('--ascii', action='store_true', help='write an ASCII .ply file instead of binary_little_endian')
+    args = parser.parse_args()
+
+    if args.command == 'build':
+        build_index(args.source_path, args.index_path, args.gamma)
+    else:
+        select_points(args.source_path, args.output_path, args.key, args.min, args.max, args.index, not args.ascii)
@@ -0,0 +1,190 @@
+# Helpers for reading and writing TIMECUBE point clouds as .ply files.
+# Every vertex we write has the same layout as the files written by `resizeAndPlyify.js`: float x/y/z coordinates
+# followed by uchar red/green/blue, and the body can be written either as ASCII (what the JS converter produces) or as
+# `binary_little_endian`, which is several times smaller and much faster to write and load.
+# Reading is more lenient: any vertex properties are accepted, in ASCII or either binary format, and vertices are
+# streamed in chunks so files larger than memory can be processed.
+import io
+import itertools
+
+import numpy as np
+
+VERTEX_DTYPE = np.dtype([('x', '<f4'), ('y', '<f4'), ('z', '<f4'),
+                         ('red', 'u1'), ('green', 'u1'), ('blue', 'u1')])
+
+# The vertex count isn't always known when we start writing, so the header reserves this many digits for it and the
+# real count is filled in (zero-padded) once writing has finished
+_COUNT_DIGITS = 15
+
+
+def ply_header(num_vertices, binary=True, count_digits=None):
+    count = str(num_vertices) if count_digits is None else str(num_vertices).zfill(count_digits)
+    return ('ply\n' +
+            ('format binary_little_endian 1.0\n' if binary else 'format ascii 1.0\n') +
+            f'element vertex {count}\n' +
+            'property float x\nproperty float y\nproperty float z\n' +
+            'property uchar red\nproperty uchar green\nproperty uchar blue\n' +
+            'end_header\n')
+
+
+# Write a structured array of `VERTEX_DTYPE` vertices to an open (binary) file, in the given body format
+def write_vertices(f, vertices, binary=True):
+    if binary:
+        f.write(vertices.tobytes())
+        return
+    # Match the JS converter's output, which prints whole-number coordinates without a decimal point
+    columns = np.column_stack([vertices[name] for name in VERTEX_DTYPE.names]).astype(np.float64)
+    np.savetxt(f, columns, fmt='%.9g %.9g %.9g %d %d %d')
+
+
+# Streams vertices into a .ply file without knowing the final vertex count up front.
+# Vertices are buffered into fixed-size chunks, so memory use doesn't depend on how many are written in total.
+# Use as a context manager, or call `close()` when done so the header's vertex count gets filled in.
+class PlyWriter:
+    def __init__(self, path, binary=True, chunk_size=1 << 20):
+        self.path = path
+        self.binary = binary
+        self.num_vertices = 0
+        self._chunk = np.empty(chunk_size, dtype=VERTEX_DTYPE)
+        self._filled = 0
+        self._file = open(path, 'wb')
+        self._file.write(ply_header(0, binary, _COUNT_DIGITS).encode('ascii'))
+
+    def write(self, vertices):
+        start = 0
+        while start < vertices.size:
+            count = min(vertices.size - start, self._chunk.size - self._filled)
+            self._chunk[self._filled:self._filled + count] = vertices[start:start + count]
+            self._filled += count
+            start += count
+            if self._filled == self._chunk.size:
+                self._flush()
+
+    def _flush(self):
+        if self._filled:
+            write_vertices(self._file, self._chunk[:self._filled], self.binary)
+            self.num_vertices += self._filled
+            self._filled = 0
+
+    def close(self):
+        if self._file.closed:
+            return
+        self._flush()
+        # Fill in the real vertex count (the header is the same length as before, since the count is zero-padded)
+        self._file.seek(0)
+        self._file.write(ply_header(self.num_vertices, self.binary, _COUNT_DIGITS).encode('ascii'))
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+# NumPy equivalents of the PLY property types
+_PLY_TYPES = {
+    'char': 'i1', 'int8': 'i1', 'uchar': 'u1', 'uint8': 'u1',
+    'short': 'i2', 'int16': 'i2', 'ushort': 'u2', 'uint16': 'u2',
+    'int': 'i4', 'int32': 'i4', 'uint': 'u4', 'uint32': 'u4',
+    'float': 'f4', 'float32': 'f4', 'double': 'f8', 'float64': 'f8',
+}
+_BYTE_ORDERS = {'ascii': '<', 'binary_little_endian': '<', 'binary_big_endian': '>'}
+
+
+# Everything we need to know about a .ply file to stream its vertices
+class PlyHeader:
+    def __init__(self, format, vertex_count, vertex_dtype, header_size, header_lines, vertex_element_first):
+        self.format = format
+        self.vertex_count = vertex_count
+        # Layout of one vertex record (for binary files this is also its exact on-disk layout)
+        self.vertex_dtype = vertex_dtype
+        # Size of the header in bytes, i.e. where the body starts
+        self.header_size = header_size
+        self.header_lines = header_lines
+        # Whether the vertices are the first element in the body, so that their position in the file is known
+        self.vertex_element_first = vertex_element_first
+
+    @property
+    def binary(self):
+        return self.format != 'ascii'
+
+
+def read_ply_header(f):
+    if f.readline().strip() != b'ply':
+        raise Exception("Not a .ply file")
+    header_lines = [b'ply\n']
+    format = None
+    vertex_count = None
+    vertex_properties = []
+    current_element = None
+    elements = []
+    for line in iter(f.readline, b''):
+        header_lines.append(line)
+        words = line.decode('ascii', 'replace').split()
+        if not words:
+            continue
+        if words[0] == 'format':
+            format = words[1]
+            if format not in _BYTE_ORDERS:
+                raise Exception(f"Unsupported .ply format `{format}`")
+        elif words[0] == 'element':
+            current_element = words[1]
+            elements.append(current_element)
+            if current_element == 'vertex':
+                vertex_count = int(words[2])
+        elif words[0] == 'property' and current_element == 'vertex':
+            if words[1] == 'list':
+                raise Exception("List properties on vertices aren't supported")
+            if words[1] not in _PLY_TYPES:
+                raise Exception(f"Unknown .ply property type `{words[1]}`")
+            vertex_properties.append((words[2], _BYTE_ORDERS[format] + _PLY_TYPES[words[1]]))
+        elif words[0] == 'end_header':
+            break
+    else:
+        raise Exception("The .ply header has no `end_header` line")
+
+    if format is None or vertex_count is None:
+        raise Exception("The .ply header doesn't describe any vertices")
+    return PlyHeader(format, vertex_count, np.dtype(vertex_properties), sum(len(line) for line in header_lines),
+                     header_lines, elements[0] == 'vertex')
+
+
+# Yield the vertices of the .ply file at `path` as structured arrays (with the file's own vertex layout) of at most
+# `chunk_size` vertices each
+def iter_ply_vertices(path, chunk_size=1 << 20):
+    with open(path, 'rb') as f:
+        header = read_ply_header(f)
+        if not header.vertex_element_first:
+            raise Exception("Only .ply files whose vertices come before any other element can be streamed")
+
+        if header.binary:
+            remaining = header.vertex_count
+            while remaining:
+                count = min(chunk_size, remaining)
+                data = f.read(count * header.vertex_dtype.itemsize)
+                if len(data) != count * header.vertex_dtype.itemsize:
+                    raise Exception("The .ply file ended before all of its vertices were read")
+                yield np.frombuffer(data, dtype=header.vertex_dtype)
+                remaining -= count
+            return
+
+        lines = io.TextIOWrapper(f, encoding='ascii')
+        remaining = header.vertex_count
+        while remaining:
+            chunk = list(itertools.islice(lines, min(chunk_size, remaining)))
+            if not chunk:
+                raise Exception("The .ply file ended before all of its vertices were read")
+            yield np.loadtxt(chunk, dtype=header.vertex_dtype.newbyteorder('='), ndmin=1)
+            remaining -= len(chunk)
+
+
+# Convert vertices with any layout into `VERTEX_DTYPE` ones (points without a color come out white)
+def to_timecube_vertices(vertices):
+    converted = np.empty(vertices.size, dtype=VERTEX_DTYPE)
+    for name in VERTEX_DTYPE.names:
+        if name in vertices.dtype.names:
+            converted[name] = vertices[name]
+        else:
+            converted[name] = 255
+    return converted
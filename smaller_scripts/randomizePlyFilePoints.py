@@ -1,41 +1,132 @@
 # This script randomizes the order of points in a .ply file:
-#     It opens the input PLY file and reads all lines into memory.
-#     It divides the lines into header and body, based on the 'end_header' line in the PLY file.
-#     It then shuffles the body lines, which correspond to the vertices of your model.
-#     Finally, it writes the header and shuffled body lines to a new PLY file.
-import random
-
-def shuffle_ply_file(input_filename, output_filename):
-    try:
-        with open(input_filename, 'r') as f:
-            lines = f.readlines()
-
-        header = []
-        body = []
-
-        for line in lines:
-            if line.startswith('element vertex'):
-                num_vertices = int(line.split()[-1])
-            if line.startswith('end_header'):
-                header.append(line)
+#     It reads the input PLY file's header, and copies it unchanged to a new PLY file.
+#     It then shuffles the body's vertex records, which correspond to the points of your model, and writes them after
+#     the header. Anything after the vertices (e.g. faces) is copied over as-is.
+# Both ASCII and binary (`binary_little_endian`/`binary_big_endian`) files are supported.
+#
+# Files are shuffled in bounded memory, so multi-GB TIMECUBEs work too. If the vertices don't fit in `memory_limit`
+# bytes, an external bucket shuffle is used: every vertex is sent to a random temporary bucket file, and then each
+# bucket is shuffled in memory and appended to the output. (Binary bodies are read through a memory map, since every
+# vertex record has the same size.) Every ordering is equally likely either way, and passing a `seed` makes the result
+# reproducible.
+#
+# Example:
+#     python randomizePlyFilePoints.py timecube.ply output.ply --seed 42
+import argparse
+import math
+import os
+import shutil
+import tempfile
+
+import numpy as np
+
+from ply_io import read_ply_header
+
+DEFAULT_MEMORY_LIMIT = 256 * 1024 * 1024
+
+
+# Yield the vertex records of an ASCII .ply body as lists of (newline-terminated) lines
+def _iter_ascii_records(f, vertex_count, chunk_size):
+    remaining = vertex_count
+    while remaining:
+        chunk = []
+        for line in f:
+            chunk.append(line if line.endswith(b'\n') else line + b'\n')
+            if len(chunk) == min(chunk_size, remaining):
                 break
-            header.append(line)
+        if not chunk:
+            raise Exception("The .ply file ended before all of its vertices were read")
+        remaining -= len(chunk)
+        yield chunk
+
+
+# Yield the vertex records of a binary .ply body as `(n, record_size)` uint8 arrays, read through a memory map
+def _iter_binary_records(path, header, chunk_size):
+    record_size = header.vertex_dtype.itemsize
+    if header.vertex_count == 0:
+        return
+    body = np.memmap(path, dtype=np.uint8, mode='r', offset=header.header_size,
+                     shape=(header.vertex_count, record_size))
+    for start in range(0, header.vertex_count, chunk_size):
+        yield np.array(body[start:start + chunk_size])
+
+
+def _records_to_bytes(records, order):
+    if isinstance(records, np.ndarray):
+        return records[order].tobytes()
+    return b''.join(records[i] for i in order)
+
+
+def shuffle_ply_file(input_filename, output_filename, seed=None, memory_limit=DEFAULT_MEMORY_LIMIT):
+    rng = np.random.default_rng(seed)
+    with open(input_filename, 'rb') as f:
+        header = read_ply_header(f)
+        if not header.vertex_element_first:
+            raise Exception("Only .ply files whose vertices come before any other element can be shuffled")
+
+        # Estimate how much memory the vertices take up, to decide how many buckets are needed
+        if header.binary:
+            record_bytes = header.vertex_dtype.itemsize
+        else:
+            # ASCII lines end up as Python bytes objects, which cost quite a bit more than the text itself
+            record_bytes = (os.path.getsize(input_filename) - header.header_size) / max(header.vertex_count, 1) + 40
+        num_buckets = max(1, math.ceil(header.vertex_count * record_bytes / memory_limit))
+        chunk_size = max(1, int(memory_limit // record_bytes // 4))
+        if num_buckets == 1:
+            # All the vertices fit in memory, so read them as a single chunk and shuffle them in one go
+            chunk_size = max(1, header.vertex_count)
+
+        if header.binary:
+            records = _iter_binary_records(input_filename, header, chunk_size)
+            f.seek(header.header_size + header.vertex_count * header.vertex_dtype.itemsize)
+        else:
+            records = _iter_ascii_records(f, header.vertex_count, chunk_size)
 
-        body = lines[len(header):]
-        body = [body[n:n+1] for n in range(0, len(body), 1)]
+        with open(output_filename, 'wb') as out, \
+                tempfile.TemporaryDirectory(dir=os.path.dirname(os.path.abspath(output_filename))) as temp_dir:
+            out.writelines(header.header_lines)
 
-        random.shuffle(body)
+            if num_buckets == 1:
+                for chunk in records:
+                    out.write(_records_to_bytes(chunk, rng.permutation(len(chunk))))
+            else:
+                # Scatter every vertex into a random bucket...
+                bucket_paths = [os.path.join(temp_dir, f'bucket{bucket}') for bucket in range(num_buckets)]
+                buckets = [open(path, 'wb') for path in bucket_paths]
+                try:
+                    for chunk in records:
+                        assignment = rng.integers(0, num_buckets, size=len(chunk))
+                        order = np.argsort(assignment, kind='stable')
+                        ends = np.cumsum(np.bincount(assignment, minlength=num_buckets))
+                        for bucket, start, end in zip(buckets, np.append(0, ends[:-1]), ends):
+                            bucket.write(_records_to_bytes(chunk, order[start:end]))
+                finally:
+                    for bucket in buckets:
+                        bucket.close()
 
-        with open(output_filename, 'w') as f:
-            f.writelines(header)
-            for chunk in body:
-                f.writelines(chunk)
+                # ...then shuffle each bucket in memory and append it to the output
+                for path in bucket_paths:
+                    if header.binary:
+                        bucket = np.fromfile(path, dtype=np.uint8).reshape(-1, header.vertex_dtype.itemsize)
+                    else:
+                        with open(path, 'rb') as bucket_file:
+                            bucket = bucket_file.readlines()
+                    out.write(_records_to_bytes(bucket, rng.permutation(len(bucket))))
+                    del bucket
+                    os.remove(path)
 
-    except Exception as e: print(e)
+            # Copy over anything that comes after the vertices
+            shutil.copyfileobj(f, out)
 
 
-shuffle_ply_file('timecube.ply', 'output.ply')
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Randomize the order of the points in a .ply file.')
+    parser.add_argument('input_filename', nargs='?', default='timecube.ply')
+    parser.add_argument('output_filename', nargs='?', default='output.ply')
+    parser.add_argument('--seed', type=int, help='random seed, for reproducible output')
+    parser.add_argument('--memory-mb', type=float, default=DEFAULT_MEMORY_LIMIT / 1024 / 1024,
+                        help='roughly how much memory the shuffle may use')
+    args = parser.parse_args()
 
-print('Type anything and press enter to exit') 
-x = input()
-print('Hello, ' + x) 
+    shuffle_ply_file(args.input_filename, args.output_filename, args.seed, int(args.memory_mb * 1024 * 1024))
+    print('Shuffled', args.input_filename, 'into', args.output_filename)
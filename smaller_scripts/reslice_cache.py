@@ -0,0 +1,98 @@
+# In-memory cache for re-slicing the same video over and over, e.g. while the user nudges the TIMEKNIFE plane in the
+# slicer and re-exports after every little adjustment. Only the resident worker (see `run_worker` in
+# `takeVideoCrossSection.py`) lives long enough to benefit, so that's the only place it's used.
+#     Samples: the gathered pixels of the last few requests, keyed by their position in the video
+#     (`(frame * height + y) * width + x`). A new request only has to gather the samples none of them had.
+#     Frames: the most recently decoded frames, so the missing samples can often be gathered without decoding at all.
+# Both parts are bounded in memory and evict the least recently used entries first.
+#
+# The total budget can be changed with the `TIMECUBE_RESLICE_CACHE_MB` environment variable (0 turns the cache off).
+# A quarter of it goes to samples, and the rest to frames. The worker shares that one budget between the caches of all
+# the videos it keeps open (see `set_budget`).
+import os
+from collections import OrderedDict
+
+import numpy as np
+
+DEFAULT_BUDGET_MB = 1024
+# Number of requests whose samples are kept
+DEFAULT_MAX_REQUESTS = 8
+
+
+def get_budget_bytes():
+    return int(float(os.environ.get('TIMECUBE_RESLICE_CACHE_MB', DEFAULT_BUDGET_MB)) * 1024 * 1024)
+
+
+class ResliceCache:
+    def __init__(self, budget_bytes=None, max_requests=DEFAULT_MAX_REQUESTS):
+        self.max_requests = max_requests
+        # Per request: sorted unique sample keys, and the `(n, 3)` BGR pixels at those keys. Most recently used last.
+        self._requests = OrderedDict()
+        self._sample_bytes = 0
+        self._next_request = 0
+        # Frame number -> decoded BGR frame. Most recently used last.
+        self._frames = OrderedDict()
+        self._frame_bytes = 0
+        self.set_budget(get_budget_bytes() if budget_bytes is None else budget_bytes)
+
+    # Change the total budget, evicting whatever no longer fits
+    def set_budget(self, budget_bytes):
+        self.max_sample_bytes = budget_bytes // 4
+        self.max_frame_bytes = budget_bytes - self.max_sample_bytes
+        self._evict()
+
+    def _evict(self):
+        while len(self._requests) > self.max_requests or self._sample_bytes > self.max_sample_bytes:
+            _, (old_keys, old_values) = self._requests.popitem(last=False)
+            self._sample_bytes -= old_keys.nbytes + old_values.nbytes
+        while self._frame_bytes > self.max_frame_bytes:
+            _, old_frame = self._frames.popitem(last=False)
+            self._frame_bytes -= old_frame.nbytes
+
+    # Fill in `values[i]` for every `keys[i]` one of the cached requests has, and return a mask of the keys found
+    def lookup(self, keys, values):
+        found = np.zeros(keys.size, dtype=bool)
+        # Iterate over a copy, since hits move their request to the end of `_requests`
+        for request, (cached_keys, cached_values) in reversed(list(self._requests.items())):
+            remaining = np.flatnonzero(~found)
+            if remaining.size == 0:
+                break
+            positions = np.searchsorted(cached_keys, keys[remaining])
+            positions[positions == cached_keys.size] = 0
+            hits = cached_keys[positions] == keys[remaining]
+            if hits.any():
+                values[remaining[hits]] = cached_values[positions[hits]]
+                found[remaining[hits]] = True
+                self._requests.move_to_end(request)
+        return found
+
+    # Remember the samples of a request (keys may be in any order, and may repeat)
+    def add_samples(self, keys, values):
+        keys, first = np.unique(keys, return_index=True)
+        entry = (keys, values[first])
+        size = keys.nbytes + entry[1].nbytes
+        if keys.size == 0 or size > self.max_sample_bytes:
+            return
+        self._requests[self._next_request] = entry
+        self._next_request += 1
+        self._sample_bytes += size
+        self._evict()
+
+    def get_frame(self, frame_index):
+        frame = self._frames.get(frame_index)
+        if frame is not None:
+            self._frames.move_to_end(frame_index)
+        return frame
+
+    def add_frame(self, frame_index, frame):
+        if frame.nbytes > self.max_frame_bytes or frame_index in self._frames:
+            return
+        self._frames[frame_index] = frame
+        self._frame_bytes += frame.nbytes
+        self._evict()
+
+    def clear(self):
+        self._requests.clear()
+        self._sample_bytes = 0
+        self._frames.clear()
+        self._frame_bytes = 0
@@ -0,0 +1,115 @@
+# Shared code for turning a sequence of frames into a video file, used by `images_to_video` (in both
+# `takeVideoCrossSection.py` and `video_from_frame_images.py`) and by the animation exports.
+#     Frames can come from a folder of numbered images, which are decoded ahead of the writer by a pool of threads (cv2
+#     releases the GIL while decoding, so PNG decoding no longer holds up the encoder), or straight from an iterator of
+#     BGR uint8 NumPy frames, so callers that render frames in memory never have to touch the disk.
+#     Frames are always written in order, and every frame has to be the same size as the first one.
+#     The codec (a FourCC such as `mp4v` or `avc1`) and frame rate can be chosen, and the encoding throughput is
+#     reported in frames per second once the video is done.
+#
+# Example:
+#     python sequence_encoder.py "3D creations/output_frames" "output_frames from video.mp4" --fps 24
+import argparse
+import os
+import re
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import cv2
+
+from export_instrumentation import trace
+
+DEFAULT_CODEC = 'mp4v'
+
+
+def default_threads():
+    return min(8, os.cpu_count() or 1)
+
+
+# Paths of the images in `image_dir` with the given extension, sorted by their number rather than by their string
+# representation (so `frame_10.png` comes after `frame_9.png`)
+def list_frame_images(image_dir, extension='.png'):
+    images = [img for img in os.listdir(image_dir) if img.endswith(extension)]
+    images.sort(key=lambda img: int(re.findall(r'\d+', os.path.splitext(img)[0])[0]))
+    return [os.path.join(image_dir, image) for image in images]
+
+
+# Decode the images at `paths` with a pool of `threads` threads, yielding them in order. At most `window` images are
+# decoded ahead of the consumer, which bounds the memory used.
+def read_images(paths, threads=None, window=None):
+    threads = threads or default_threads()
+    window = window or threads * 2
+    with ThreadPoolExecutor(max_workers=threads) as pool:
+        pending = deque()
+        for path in paths:
+            pending.append((path, pool.submit(cv2.imread, path)))
+            if len(pending) >= window:
+                yield _loaded_image(*pending.popleft())
+        while pending:
+            yield _loaded_image(*pending.popleft())
+
+
+def _loaded_image(path, future):
+    image = future.result()
+    if image is None:
+        raise Exception("Could not read image `" + path + "`")
+    return image
+
+
+# Write an iterable of BGR uint8 frames into a video at `video_path`, returning `{"frames", "seconds", "fps"}`.
+# `total` (the number of frames, if known) is only used for progress messages.
+def encode_frames(frames, video_path, fps=24, codec=DEFAULT_CODEC, total=None):
+    start = time.perf_counter()
+    video = None
+    size = None
+    count = 0
+    try:
+        for frame in frames:
+            if video is None:
+                # Create a VideoWriter object, sized to the first frame
+                size = (frame.shape[1], frame.shape[0])
+                fourcc = cv2.VideoWriter_fourcc(*codec)
+                video = cv2.VideoWriter(video_path, fourcc, fps, size)
+                if not video.isOpened():
+                    raise Exception("Could not create video file `" + video_path + "`")
+            elif (frame.shape[1], frame.shape[0]) != size:
+                raise Exception(f"Frame {count} is {frame.shape[1]}x{frame.shape[0]}, but the video is "
+                                f"{size[0]}x{size[1]}")
+            with trace.accumulate('encode'):
+                video.write(frame)
+            count += 1
+            if total is not None:
+                trace.progress('encode', count, total)
+    finally:
+        # Release the VideoWriter object
+        if video is not None:
+            video.release()
+
+    if count == 0:
+        raise Exception("No frames to encode into `" + video_path + "`")
+    seconds = time.perf_counter() - start
+    stats = {'frames': count, 'seconds': seconds, 'fps': count / seconds if seconds > 0 else float('inf')}
+    print(f"Encoded {count} frames into `{video_path}` in {seconds:.2f} s ({stats['fps']:.1f} frames per second)")
+    return stats
+
+
+# Turn the numbered images in `image_dir` into a video
+def encode_image_sequence(image_dir, video_path, fps=24, codec=DEFAULT_CODEC, threads=None, extension='.png'):
+    paths = list_frame_images(image_dir, extension)
+    if not paths:
+        raise Exception(f"No {extension} images found in `{image_dir}`")
+    return encode_frames(read_images(paths, threads), video_path, fps, codec, total=len(paths))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Turn a folder of numbered images into a video file.')
+    parser.add_argument('image_dir')
+    parser.add_argument('video_path')
+    parser.add_argument('--fps', type=float, default=24)
+    parser.add_argument('--codec', default=DEFAULT_CODEC, help='FourCC of the codec to encode with')
+    parser.add_argument('--threads', type=int, help='number of threads decoding images (default: up to 8)')
+    parser.add_argument('--extension', default='.png')
+    args = parser.parse_args()
+
+    encode_image_sequence(args.image_dir, args.video_path, args.fps, args.codec, args.threads, args.extension)
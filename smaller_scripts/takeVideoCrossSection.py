@@ -4,17 +4,33 @@
 # video, so that we won't have to "rewind" the video.
 
 import json
+import base64
 import cv2
 import os
-import re
 import numpy as np
 from PIL import Image, PngImagePlugin
 import datetime
 import sys
-
-# This bit is for profiling the code; comment out before release
-import cProfile, pstats, io
-# End of profiling code segment
+import contextlib
+import io
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+
+import video_volume_cache
+from reslice_cache import ResliceCache, get_budget_bytes as reslice_budget_bytes
+from timecube_format import TimecubeReader
+from brick_volume import BrickVolumeReader
+from delta_volume import DeltaVolumeReader
+from export_instrumentation import trace
+from frame_prefetch import FramePrefetcher
+from sequence_encoder import DEFAULT_CODEC, encode_frames
+# Turning a folder of images into a video file lives in `video_from_frame_images.py`; it is re-exported here for older
+# callers of this script's `images_to_video`
+from video_from_frame_images import images_to_video
+from video_capture import open_capture, release_capture, seek_video, unseekable_captures
+
+# For profiling the code (see `TIMECUBE_PROFILE` in `run_export`)
+import cProfile, pstats
 
 # ## Check our location in the computer for troubleshooting
 # print(os.getcwd()) # get current working directory
@@ -31,11 +47,15 @@ import cProfile, pstats, io
 # print("Script directory:", script_dir)
 
 
-# We only need three coordinate points to define the input rectangle: the top left point `p1`, the top left point `p2`,
-# and a bottem left point `p3`. We can then calculate the fourth point internally.
-def create_cross_section(video_path, points, resolutions, outputName):
+# Convert a path relative to this script into an absolute path (absolute paths are left as they are)
+def script_relative_path(path):
+    return os.path.normpath(os.path.join(os.path.dirname(os.path.abspath(__file__)), path))
+
+
+# Resolve `video_path` relative to this script, and make sure it exists
+def resolve_video_path(video_path):
     # Convert relative path to absolute path
-    absolute_video_path = os.path.normpath(os.path.join(os.path.dirname(os.path.abspath(__file__)), video_path))
+    absolute_video_path = script_relative_path(video_path)
 
     print('Attempting to open video file at path:', absolute_video_path)
     # Check if file exists
@@ -43,87 +63,600 @@ def create_cross_section(video_path, points, resolutions, outputName):
         raise Exception(f"Video file does not exist: {absolute_video_path}")
     else:
         print('file exists!')
-        
+    return absolute_video_path
+
+
+# The decoded-volume cache can be switched off by setting the `TIMECUBE_VOLUME_CACHE` environment variable to 0
+def volume_cache_enabled():
+    return os.environ.get('TIMECUBE_VOLUME_CACHE', '1') != '0'
+
+
+# Sources kept open between requests by the resident worker (see `run_worker`), most recently used last.
+# None when sources aren't being kept warm, i.e. for one-off command-line runs.
+warm_sources = None
+max_warm_sources = 4
+# Re-slice caches (see `reslice_cache.py`) of the warm sources that have to be decoded, by `id()` of the source. They
+# share one budget between them (see `_share_reslice_budget`).
+reslice_caches = {}
+
+
+def keep_sources_warm(max_sources=4):
+    global warm_sources, max_warm_sources
+    warm_sources = OrderedDict()
+    max_warm_sources = max_sources
+
+
+def close_warm_sources():
+    global warm_sources
+    if warm_sources is not None:
+        for source, *_ in warm_sources.values():
+            _release(source)
+    warm_sources = None
+    reslice_caches.clear()
+
+
+def reslice_cache_for(source):
+    return reslice_caches.get(id(source))
+
+
+# Split the re-slice cache budget evenly between the warm sources' caches, so that together they never hold more than
+# `TIMECUBE_RESLICE_CACHE_MB`, however many videos are open
+def _share_reslice_budget():
+    for cache in reslice_caches.values():
+        cache.set_budget(reslice_budget_bytes() // len(reslice_caches))
+
+
+# Open the video at `video_path` and return a frame source along with the video's dimensions and duration (in frames).
+# The frame source is the video's cached, memory-mapped `(frames, height, width, 3)` volume when there is one (see
+# `video_volume_cache.py`), so repeat exports don't decode anything; otherwise it is a plain `cv2.VideoCapture`.
+# `.timecube` files (see `timecube_format.py`) are read directly, decompressing only the frame ranges that get sampled.
+def open_video(video_path, use_cache=True):
+    with trace.stage('open'):
+        return _open_video(video_path, use_cache)
+
+
+def _open_video(video_path, use_cache):
+    absolute_video_path = resolve_video_path(video_path)
+
+    # Reuse a source that is still open from an earlier request, if the worker is keeping them around
+    if warm_sources is not None:
+        stat = os.stat(absolute_video_path)
+        key = (absolute_video_path, stat.st_size, stat.st_mtime_ns, use_cache and volume_cache_enabled())
+        if key in warm_sources:
+            warm_sources.move_to_end(key)
+            # Captures are left wherever the last request stopped; `read_needed_frames` seeks as needed
+            return warm_sources[key]
+
+        opened = _open_video_source(absolute_video_path, use_cache)
+        warm_sources[key] = opened
+        # Only sources that need decoding get a re-slice cache; the others are random access already
+        if isinstance(opened[0], (cv2.VideoCapture, TimecubeReader)) and reslice_budget_bytes() > 0:
+            reslice_caches[id(opened[0])] = ResliceCache()
+        while len(warm_sources) > max_warm_sources:
+            _, (old_source, *_) = warm_sources.popitem(last=False)
+            reslice_caches.pop(id(old_source), None)
+            _release(old_source)
+        if reslice_caches:
+            _share_reslice_budget()
+        return opened
+
+    return _open_video_source(absolute_video_path, use_cache)
+
+
+# Readers for volume formats that are sliced directly instead of being decoded, by file extension. A reader is opened
+# with the file's absolute path, and has to have a `(frames, height, width, 3)` `shape`, return frames (or anything
+# supporting `frame[ys, xs]`) for `reader[frame_index]`, and have a `close()` method. Readers may also have a
+# `plan_planes(corners)` method, which is told the video-space corners of the planes about to be sliced.
+VOLUME_READERS = {
+    '.timecube': TimecubeReader,  # See `timecube_format.py`
+    '.tcbricks': BrickVolumeReader,  # See `brick_volume.py`
+    '.tcdelta': DeltaVolumeReader,  # See `delta_volume.py`
+}
+
+
+def _open_video_source(absolute_video_path, use_cache):
+    extension = os.path.splitext(absolute_video_path)[1].lower()
+    if extension in VOLUME_READERS:
+        reader = VOLUME_READERS[extension](absolute_video_path)
+        duration, height, width = reader.shape[:3]
+        return reader, width, height, duration
+
+    if use_cache and volume_cache_enabled():
+        volume, duration = video_volume_cache.load_volume(absolute_video_path)
+        if volume is not None:
+            # The duration is the container's reported frame count, like below, so planes scale the same either way
+            height, width = volume.shape[1:3]
+            return volume, width, height, duration
+
     # Get the original video's dimensions and duration (in frames)
-    # print('Attempting to open video file at path:', video_path)
-    cap = cv2.VideoCapture(absolute_video_path)
-    if not cap.isOpened():
-        raise Exception("Could not open `" + absolute_video_path +  "`. Check to make sure the file actually exists, and is in .mp4 format")
-    
+    cap = open_capture(absolute_video_path)
+
     width = cap.get(cv2.CAP_PROP_FRAME_WIDTH)
     height = cap.get(cv2.CAP_PROP_FRAME_HEIGHT)
     duration = cap.get(cv2.CAP_PROP_FRAME_COUNT)
+    return cap, width, height, duration
+
 
-    # Unpack corner points and resolutions (meaning the number of points to have spaced evenly inside the plane)
-    p1, p2, p3 = points
+def _release(source):
+    if isinstance(source, cv2.VideoCapture):
+        release_capture(source)
+    elif isinstance(source, tuple(VOLUME_READERS.values())):
+        source.close()
+
+
+# Release a source from `open_video` once we're done with it (unless the worker is keeping it warm)
+def close_video(source):
+    if warm_sources is not None and any(source is warm[0] for warm in warm_sources.values()):
+        return
+    _release(source)
+
+
+# Convert a list of points from three.js space (0-100 along every axis) to original video space.
+# The input lists are left untouched; NumPy copies are returned instead.
+def scale_points_to_video(points, width, height, duration):
+    scaling_factors = np.array([width / 100, height / 100, duration / 100])
+    return [np.asarray(point, dtype=np.float64) * scaling_factors for point in points]
+
+
+# Make resolution percentages relative to the original video's dimensions.
+def scale_resolutions_to_video(resolutions, width, height):
     width_res, height_res = resolutions
-    print('width_res: ', width_res, ', height_res: ', height_res)
+    return int(width_res * width / 100), int(height_res * height / 100)
 
-    # Convert points and resolutions from three.js space to original video space
-    # List of points
-    point_list = [p1, p2, p3]
-    # Scaling factors
-    scaling_factors = [width / 100, height / 100, duration / 100]
-    # Scale the points
-    for point in point_list:
-        for i in range(3):
-            point[i] *= scaling_factors[i]
-    # Make resolutions relative to plane
-    width_res = int(width_res * width / 100)
-    height_res = int(height_res * height / 100)
+
+# Calculate the (rounded) video-space center of every sample on the plane defined by `p1` (top left), `p2` (top right)
+# and `p3` (bottom left). Returns three `(height_res, width_res)` integer arrays holding the x, y and z (frame)
+# coordinates of each output pixel.
+# The arithmetic is done in the same order as the old per-pixel loop, so the rounded centers are identical to it
+# (`np.rint` rounds halves to even, just like Python's `round`).
+def plane_sample_coordinates(p1, p2, p3, width_res, height_res):
+    # Calculate width and height vectors
+    width_vector = (p2 - p1) / width_res
+    height_vector = (p3 - p1) / height_res
+
+    # Offsets of each segment's center, along the plane's width and height
+    j = np.arange(width_res) + 0.5
+    i = np.arange(height_res) + 0.5
+
+    centers = p1 + j[np.newaxis, :, np.newaxis] * width_vector + i[:, np.newaxis, np.newaxis] * height_vector
+    centers = np.rint(centers).astype(np.int64)
+    return centers[..., 0], centers[..., 1], centers[..., 2]
+
+
+# Mask of the samples that fall inside the video. Everything outside of it is left black.
+def in_bounds(xs, ys, zs, width, height, duration):
+    return (zs >= 0) & (zs < duration) & (xs >= 0) & (xs < width) & (ys >= 0) & (ys < height)
+
+
+# When the next frame we need is more than this many frames ahead, seek to it instead of reading forward. Seeking
+# makes the decoder restart from the closest keyframe before the target, so it only pays off for gaps longer than a
+# typical keyframe interval.
+SEEK_THRESHOLD = 60
+
+
+# Read the frames listed in `frame_indices` (sorted, ascending) from a frame source opened by `open_video`, yielding
+# `(frame_index, frame)` pairs.
+# Only the listed frames are fully decoded: we seek past long runs of frames the slice never samples (including
+# everything before the first needed frame), `grab()` (without `retrieve()`) the short runs, and stop as soon as the
+# last needed frame has been read.
+def read_needed_frames(source, frame_indices):
+    # Cached volumes are already decoded, so just hand out views into them
+    if not isinstance(source, cv2.VideoCapture):
+        for needed_index in frame_indices:
+            trace.count('frames_read')
+            yield needed_index, source[needed_index]
+        return
+
+    cap = source
+    # Index of the next frame the capture will decode
+    position = int(cap.get(cv2.CAP_PROP_POS_FRAMES))
+    for needed_index in frame_indices:
+        seekable = id(cap) not in unseekable_captures
+        if needed_index < position or (seekable and needed_index - position > SEEK_THRESHOLD):
+            trace.count('frames_skipped', max(0, needed_index - position))
+            trace.count('seeks')
+            position = seek_video(cap, needed_index)
+
+        # Skip over frames we don't need without converting them
+        trace.count('frames_grabbed', needed_index - position)
+        while position < needed_index:
+            if not cap.grab():
+                raise Exception("Couldn't read video")
+            position += 1
+
+        ret, frame = cap.read()
+        if not ret:
+            raise Exception("Couldn't read video")
+        trace.count('frames_decoded')
+        position += 1
+        yield needed_index, frame
+
+
+# Smallest unsigned integer type able to hold every value up to `max_value`, so the sample index below costs a few
+# bytes per sample rather than a few Python objects.
+def compact_dtype(max_value):
+    if max_value < 2 ** 16:
+        return np.uint16
+    if max_value < 2 ** 32:
+        return np.uint32
+    return np.int64
+
+
+# Array-backed index of every in-bounds sample of one or more planes, bucketed by frame number (CSR-style).
+# The samples of frame `f` live at `offsets[f]:offsets[f + 1]` of the flat `step`/`row`/`col`/`x`/`y` arrays, so
+# looking up a frame's samples is O(1), and `frames` lists (in ascending order) the frames that have any samples at all.
+# `first_frame` and `last_frame` hold the first and last frame each step samples from (-1 for steps without any
+# in-bounds samples), which is what lets steps be streamed out as soon as they're finished (see `stream_steps`).
+class FrameSampleIndex:
+    def __init__(self, frames, offsets, step, row, col, x, y, first_frame, last_frame):
+        self.frames = frames
+        self.offsets = offsets
+        self.step = step
+        self.row = row
+        self.col = col
+        self.x = x
+        self.y = y
+        self.first_frame = first_frame
+        self.last_frame = last_frame
+        # Video-space `(p1, p2, p3)` corners of every step's plane, when known (see `plan_source_reads`)
+        self.corners = None
+
+    def __len__(self):
+        return self.step.size
+
+    # Slice into the flat arrays holding the samples of `frame_index`
+    def samples(self, frame_index):
+        return slice(self.offsets[frame_index], self.offsets[frame_index + 1])
+
+    @property
+    def nbytes(self):
+        return sum(a.nbytes for a in (self.offsets, self.step, self.row, self.col, self.x, self.y))
+
+
+# Build a `FrameSampleIndex` from an iterable of `(xs, ys, zs)` coordinate arrays (as returned by
+# `plane_sample_coordinates`), one per output image. The iterable may be a generator, in which case only one plane's
+# coordinates are alive at a time.
+# Samples are bucketed by frame with a stable sort; for videos of up to 65535 frames the frame numbers fit in uint16,
+# which NumPy sorts with a radix sort, so building the index takes linear time.
+def build_frame_sample_index(planes, width, height, duration):
+    num_frames = int(np.ceil(duration))
+    frame_dtype = compact_dtype(num_frames)
+    pixel_dtype = compact_dtype(max(width, height))
+
+    steps, rows, cols, xs, ys, zs = [], [], [], [], [], []
+    first_frames, last_frames = [], []
+    num_steps = 0
+    for step, (plane_xs, plane_ys, plane_zs) in enumerate(trace.timed(planes, 'coordinates')):
+        with trace.accumulate('index'):
+            num_steps = step + 1
+            valid = in_bounds(plane_xs, plane_ys, plane_zs, width, height, duration)
+            plane_rows, plane_cols = np.nonzero(valid)
+            steps.append(step)
+            rows.append(plane_rows.astype(compact_dtype(plane_xs.shape[0])))
+            cols.append(plane_cols.astype(compact_dtype(plane_xs.shape[1])))
+            xs.append(plane_xs[valid].astype(pixel_dtype))
+            ys.append(plane_ys[valid].astype(pixel_dtype))
+            zs.append(plane_zs[valid].astype(frame_dtype))
+            first_frames.append(zs[-1].min() if zs[-1].size else -1)
+            last_frames.append(zs[-1].max() if zs[-1].size else -1)
+
+    with trace.accumulate('index'):
+        return _finish_frame_sample_index(steps, rows, cols, xs, ys, zs, first_frames, last_frames, num_steps,
+                                          num_frames, frame_dtype, pixel_dtype)
+
+
+def _finish_frame_sample_index(steps, rows, cols, xs, ys, zs, first_frames, last_frames, num_steps, num_frames,
+                               frame_dtype, pixel_dtype):
+    # Expand the step numbers only once we know how many samples each step has
+    step_dtype = compact_dtype(num_steps)
+    steps = [np.full(plane_rows.size, step, dtype=step_dtype) for step, plane_rows in zip(steps, rows)]
+
+    def concatenate(arrays, dtype):
+        return np.concatenate(arrays).astype(dtype, copy=False) if arrays else np.zeros(0, dtype=dtype)
+
+    row_dtype = np.result_type(*rows) if rows else np.uint16
+    col_dtype = np.result_type(*cols) if cols else np.uint16
+    step = concatenate(steps, step_dtype)
+    row = concatenate(rows, row_dtype)
+    col = concatenate(cols, col_dtype)
+    x = concatenate(xs, pixel_dtype)
+    y = concatenate(ys, pixel_dtype)
+    z = concatenate(zs, frame_dtype)
+    del steps, rows, cols, xs, ys, zs
+
+    # Bucket the samples by frame: the per-frame counts give the CSR offsets, and a stable sort by frame number
+    # puts each bucket's samples (still in step order) in place
+    counts = np.bincount(z, minlength=num_frames)
+    offsets = np.zeros(num_frames + 1, dtype=np.int64)
+    np.cumsum(counts, out=offsets[1:])
+    order = np.argsort(z, kind='stable')
+    del z
+
+    return FrameSampleIndex(np.flatnonzero(counts), offsets,
+                            step[order], row[order], col[order], x[order], y[order],
+                            np.array(first_frames, dtype=np.int64), np.array(last_frames, dtype=np.int64))
+
+
+# Tell sources that can make use of it (bricked volumes, see `brick_volume.py`) which planes are about to be sliced
+def plan_source_reads(source, indexes):
+    if hasattr(source, 'plan_planes') and all(index.corners is not None for index in indexes):
+        source.plan_planes([corners for index in indexes for corners in index.corners])
+
+
+# Read the needed frames of `source` on a background thread (see `frame_prefetch.py`), so decoding overlaps with
+# sampling. Decoded volumes are plain arrays whose frames cost nothing to "read", so they're read directly.
+def prefetch_needed_frames(source, frame_indices):
+    depth = 0 if isinstance(source, np.ndarray) else None
+    return FramePrefetcher(read_needed_frames(source, frame_indices), depth)
+
+
+# Pixels of `frame` at the given samples of `index`, in RGB order instead of OpenCV's BGR if `rgb` is set. Reversing the
+# channel axis is just a view, so the color conversion costs nothing on top of the gather itself.
+def gather_pixels(frame, index, samples, rgb=False):
+    pixels = frame[index.y[samples], index.x[samples]]
+    return pixels[:, ::-1] if rgb else pixels
+
+
+# Sampling engine shared by the cross-section and animation functions.
+# `index` is a `FrameSampleIndex`, and `images` is a `(num_steps, height_res, width_res, 3)` uint8 array to paint into,
+# in RGB order if `rgb` is set (for PIL) or BGR otherwise (for OpenCV).
+# Each needed frame is read once, and its pixels are scattered into all the step images with a single
+# fancy-indexing call.
+def sample_frames(source, index, images, rgb=False):
+    sample_frames_batch(source, [(index, images, rgb)])
+
+
+# `sample_frames` for several `(index, images, rgb)` jobs over the same video (see `run_batch`): every frame needed by
+# any of them is read once, in a single pass through the video, and sampled for each of them in turn.
+def sample_frames_batch(source, jobs):
+    if len(jobs) == 1:
+        needed_frames = jobs[0][0].frames
+    else:
+        needed_frames = np.unique(np.concatenate([index.frames for index, images, rgb in jobs]))
+    plan_source_reads(source, [index for index, images, rgb in jobs])
+    with prefetch_needed_frames(source, needed_frames) as frames:
+        for done, (frame_index, frame) in enumerate(trace.timed(frames, 'decode'), start=1):
+            with trace.accumulate('gather'):
+                for index, images, rgb in jobs:
+                    samples = index.samples(frame_index)
+                    images[index.step[samples], index.row[samples], index.col[samples]] = \
+                        gather_pixels(frame, index, samples, rgb)
+            trace.progress('decode', done, needed_frames.size)
+    trace.count('samples_gathered', sum(len(index) for index, images, rgb in jobs))
+
+
+# `sample_frames` for sources with a re-slice cache (see `reslice_cache.py`): samples that an earlier request already
+# gathered are copied from the cache, and only the remaining ones are gathered, from cached frames where possible and
+# by decoding the rest. The samples and decoded frames of this request are then added to the cache.
+# `read_ahead` frames (sorted, ascending) are decoded and cached in the same pass, for a request that is known to follow
+# (see `create_progressive_cross_section`).
+def sample_frames_cached(source, index, images, cache, width, height, rgb=False, read_ahead=None):
+    width, height = int(width), int(height)
+    # Samples are sorted by frame, so each sample's frame can be read off the CSR offsets
+    z = np.repeat(index.frames, np.diff(index.offsets)[index.frames])
+    keys = (z * height + index.y) * width + index.x
+    values = np.empty((len(index), 3), dtype=np.uint8)
+    with trace.accumulate('gather'):
+        found = cache.lookup(keys, values)
+
+    missing = np.flatnonzero(~found)
+    missing_frames, starts = np.unique(z[missing], return_index=True)
+    ends = np.append(starts[1:], missing.size)
+    # Hold on to the cached frames we need now, so they can't be evicted by the frames decoded below
+    cached_frames = {frame_index: cache.get_frame(frame_index) for frame_index in missing_frames}
+    to_decode = np.array([frame_index for frame_index, frame in cached_frames.items() if frame is None],
+                         dtype=np.int64)
+    trace.count('samples_reused', int(found.sum()))
+    trace.count('frames_reused', missing_frames.size - to_decode.size)
+    if read_ahead is not None:
+        to_decode = np.union1d(to_decode, [frame_index for frame_index in read_ahead
+                                           if cache.get_frame(frame_index) is None]).astype(np.int64)
+
+    with prefetch_needed_frames(source, to_decode) as decoded:
+        decoded = trace.timed(decoded, 'decode')
+        for done, (frame_index, start, end) in enumerate(zip(missing_frames, starts, ends), start=1):
+            frame = cached_frames[frame_index]
+            # Frames only read ahead come out of the same stream, in frame order
+            while frame is None:
+                decoded_index, decoded_frame = next(decoded)
+                cache.add_frame(decoded_index, decoded_frame)
+                if decoded_index == frame_index:
+                    frame = decoded_frame
+            with trace.accumulate('gather'):
+                samples = missing[start:end]
+                values[samples] = frame[index.y[samples], index.x[samples]]
+            trace.progress('decode', done, missing_frames.size)
+        for decoded_index, decoded_frame in decoded:
+            cache.add_frame(decoded_index, decoded_frame)
+
+    with trace.accumulate('gather'):
+        images[index.step, index.row, index.col] = values[:, ::-1] if rgb else values
+    cache.add_samples(keys, values)
+    trace.count('samples_gathered', missing.size)
+
+
+# Work out which buffer of a small pool each step of `index` is sampled into when streaming (see `stream_steps`).
+# A step takes a free buffer at its first frame, and gives it back once it has been yielded; steps are yielded in step
+# order, as soon as they and all the steps before them have seen their last frame.
+# Returns the buffer of each step (-1 for steps without samples, which are simply black), the number of buffers, the
+# steps that start at each needed frame, and how many steps can be yielded after each needed frame.
+def plan_step_buffers(index):
+    num_steps = index.first_frame.size
+    position = np.full(index.offsets.size - 1, -1, dtype=np.int64)
+    position[index.frames] = np.arange(index.frames.size)
+    has_samples = index.first_frame >= 0
+    first_position = np.where(has_samples, position[index.first_frame], -1)
+    last_position = np.where(has_samples, position[index.last_frame], -1)
+
+    starting = [[] for _ in range(index.frames.size)]
+    for step in np.flatnonzero(has_samples):
+        starting[first_position[step]].append(step)
+
+    buffer_of_step = np.full(num_steps, -1, dtype=np.int64)
+    ready_after = np.zeros(index.frames.size, dtype=np.int64)
+    free_buffers = []
+    num_buffers = 0
+    next_step = 0
+    for k in range(index.frames.size):
+        for step in starting[k]:
+            if free_buffers:
+                buffer_of_step[step] = free_buffers.pop()
+            else:
+                buffer_of_step[step] = num_buffers
+                num_buffers += 1
+        while next_step < num_steps and last_position[next_step] <= k:
+            if buffer_of_step[next_step] >= 0:
+                free_buffers.append(buffer_of_step[next_step])
+            next_step += 1
+        ready_after[k] = next_step
+    return buffer_of_step, num_buffers, starting, ready_after
+
+
+# Streaming version of `sample_frames`: yield `(step, image)` pairs in step order, each as soon as every frame it needs
+# has been read, rather than filling in every step before returning any of them. Step images are sampled into a pool of
+# uint8 buffers (see `plan_step_buffers`), so memory use depends on how many steps are in progress at once (a handful,
+# for a plane sweeping through the video) rather than on the number of steps.
+# The yielded images are views into the pool, so they're only valid until the next step is requested.
+def stream_steps(source, index, image_shape, rgb=False):
+    num_steps = image_shape[0]
+    buffer_of_step, num_buffers, starting, ready_after = plan_step_buffers(index)
+    buffers = np.zeros((num_buffers,) + tuple(image_shape[1:]), dtype=np.uint8)
+    blank = np.zeros(image_shape[1:], dtype=np.uint8)
+    trace.count('step_buffers', num_buffers)
+    plan_source_reads(source, [index])
+
+    next_step = 0
+    with prefetch_needed_frames(source, index.frames) as frames:
+        for k, (frame_index, frame) in enumerate(trace.timed(frames, 'decode')):
+            with trace.accumulate('gather'):
+                # Buffers are reused, so clear them for the steps starting here
+                for step in starting[k]:
+                    buffers[buffer_of_step[step]] = 0
+                samples = index.samples(frame_index)
+                buffers[buffer_of_step[index.step[samples]], index.row[samples], index.col[samples]] = \
+                    gather_pixels(frame, index, samples, rgb)
+            trace.progress('decode', k + 1, index.frames.size)
+
+            while next_step < ready_after[k]:
+                buffer = buffer_of_step[next_step]
+                yield next_step, buffers[buffer] if buffer >= 0 else blank
+                next_step += 1
+
+    # Whatever is left has no samples at all
+    for step in range(next_step, num_steps):
+        yield step, blank
+    trace.count('samples_gathered', len(index))
+
+
+# Worker for `sample_frames_parallel`: open our own capture, seek to the start of the shard, and gather the samples of
+# the shard's frames. `offsets` are the shard's CSR offsets (relative to its own `x`/`y` arrays).
+def _sample_shard(absolute_video_path, frames, offsets, x, y):
+    cap = open_capture(absolute_video_path)
+    values = np.empty((x.size, 3), dtype=np.uint8)
+    try:
+        with prefetch_needed_frames(cap, frames) as needed_frames:
+            for k, (frame_index, frame) in enumerate(needed_frames):
+                samples = slice(offsets[k], offsets[k + 1])
+                values[samples] = frame[y[samples], x[samples]]
+    finally:
+        _release(cap)
+    return values
+
+
+# Parallel version of `sample_frames` for videos that have to be decoded: the needed frames are split into contiguous
+# shards, each decoded and sampled by its own worker process, and the partial results are merged into `images`.
+# Every sample still comes from exactly the same frame, so the result is identical to the serial path.
+def sample_frames_parallel(absolute_video_path, index, images, workers, rgb=False):
+    frames = index.frames
+    if workers <= 1 or frames.size < 2:
+        cap = open_capture(absolute_video_path)
+        try:
+            sample_frames(cap, index, images, rgb)
+        finally:
+            release_capture(cap)
+        return
+
+    # A couple of shards per worker evens out shards whose frames happen to be slower to decode
+    shards = [shard for shard in np.array_split(frames, min(frames.size, workers * 2)) if shard.size]
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = []
+        for shard in shards:
+            start, end = index.offsets[shard[0]], index.offsets[shard[-1] + 1]
+            offsets = np.append(index.offsets[shard], end) - start
+            futures.append((start, end, executor.submit(_sample_shard, absolute_video_path, shard, offsets,
+                                                        index.x[start:end], index.y[start:end])))
+        for done, (start, end, future) in enumerate(futures, start=1):
+            with trace.accumulate('decode'):
+                values = future.result()
+            with trace.accumulate('gather'):
+                images[index.step[start:end], index.row[start:end], index.col[start:end]] = \
+                    values[:, ::-1] if rgb else values
+            trace.progress('decode', done, len(futures))
+    trace.count('samples_gathered', len(index))
+
+
+# Sample the cross-section of an already opened video, returning it as an RGB uint8 image.
+# `points` and `resolutions` are in three.js space; `scale` shrinks the sample grid (e.g. 0.125 samples every 8th pixel
+# along each axis), which is used for quick previews.
+def render_cross_section(source, width, height, duration, points, resolutions, scale=1):
+    index, image_shape = plan_cross_section(width, height, duration, points, resolutions, scale)
+    return sample_cross_section(source, index, image_shape, width, height, reslice_cache_for(source))
+
+
+# Sample a planned cross-section (see `plan_cross_section`) of an already opened video into a new RGB uint8 image,
+# going through `cache` (a `ResliceCache`) if given
+def sample_cross_section(source, index, image_shape, width, height, cache=None, read_ahead=None):
+    # Initialize image array with appropriate dimensions (out-of-bounds pixels stay black)
+    images = np.zeros(image_shape, dtype=np.uint8)
+    if cache is not None:
+        sample_frames_cached(source, index, images, cache, width, height, rgb=True, read_ahead=read_ahead)
+    else:
+        sample_frames(source, index, images, rgb=True)
+    return images[0]
+
+
+# Move every in-bounds frame number in `zs` to the nearest of `frames` (sorted, ascending)
+def snap_to_frames(zs, frames, duration):
+    positions = np.clip(np.searchsorted(frames, zs), 1, max(1, frames.size - 1))
+    lower, upper = frames[positions - 1], frames[np.minimum(positions, frames.size - 1)]
+    snapped = np.where(zs - lower <= upper - zs, lower, upper)
+    return np.where((zs >= 0) & (zs < duration), snapped, zs)
+
+
+# Work out which pixels a cross-section needs, returning its `FrameSampleIndex` and the `(1, height_res, width_res, 3)`
+# shape of the image to sample them into.
+# With `snap_frames` given, samples are taken from the nearest of those frames instead of their own (see
+# `create_progressive_cross_section`).
+def plan_cross_section(width, height, duration, points, resolutions, scale=1, snap_frames=None):
+    # Convert corner points and resolutions (meaning the number of points to have spaced evenly inside the plane)
+    # from three.js space to original video space
+    p1, p2, p3 = scale_points_to_video(points, width, height, duration)
+    width_res, height_res = scale_resolutions_to_video(resolutions, width, height)
+    print('width_res: ', width_res, ', height_res: ', height_res)
 
     # Check if the resolutions are greater than zero
     if width_res <= 0 or height_res <= 0:
         print('width: ', width, ', height: ', height)
         raise Exception("Resolutions must be greater than zero")
 
-    # Calculate width and height vectors
-    width_vector = [(p2[i] - p1[i]) / width_res for i in range(3)]
-    height_vector = [(p3[i] - p1[i]) / height_res for i in range(3)]
-
-    # Initialize image array with appropriate dimensions
-    image = np.zeros((height_res, width_res, 3))
-
-    # Create a list of pixel coordinates and their original positions
-    coords = []
-    for i in range(height_res):
-        for j in range(width_res):
-            # Calculate the center of the current segment and round them to the nearest whole number
-            center = [round(p1[k] + (j + 0.5) * width_vector[k] + (i + 0.5) * height_vector[k]) for k in range(3)]
-            # Add the center and its original position to the list
-            coords.append((center, (i, j)))
-
-    # Sort the list by the z-coordinate
-    coords.sort(key=lambda n: n[0][2])
-
-    # Frame index
-    frame_index = -1
-
-    # Iterate over sorted list
-    for center, original_pos in coords:
-        # If the coordinates are out of bounds, fill with black
-        if center[2] < 0 or center[2] >= duration or center[0] < 0 or center[0] >= width or center[1] < 0 or center[
-            1] >= height:
-            image[original_pos] = [0, 0, 0]
-            continue
+    if scale != 1:
+        width_res, height_res = max(1, round(width_res * scale)), max(1, round(height_res * scale))
 
-        # If the frame index doesn't match with the z-coordinate of the current pixel,
-        # read frames until it does
-        while frame_index < center[2]:
-            ret, frame = cap.read()
-            if not ret:
-                raise Exception("Couldn't read video")
-            frame_index += 1
+    # Index every pixel on the plane by the frame it comes from
+    xs, ys, zs = plane_sample_coordinates(p1, p2, p3, width_res, height_res)
+    if snap_frames is not None and snap_frames.size:
+        zs = snap_to_frames(zs, snap_frames, duration)
+    index = build_frame_sample_index([(xs, ys, zs)], width, height, duration)
+    index.corners = [(p1, p2, p3)]
+    return index, (1, height_res, width_res, 3)
 
-        # Convert x, y to integers as they represent pixel positions
-        x, y = map(int, center[:2])
 
-        # Add pixel color to image at the original position
-        image[original_pos] = frame[y, x]
+def save_cross_section(image, outputName):
+    with trace.stage('encode'):
+        _save_cross_section(image, outputName)
 
-    # Convert BGR to RGB
-    image = cv2.cvtColor(image.astype(np.uint8), cv2.COLOR_BGR2RGB)
 
+def _save_cross_section(image, outputName):
     # Create a PIL image
     pil_image = Image.fromarray(image)
 
@@ -138,6 +671,67 @@ def create_cross_section(video_path, points, resolutions, outputName):
     pil_image.save(outputName)
 
 
+# We only need three coordinate points to define the input rectangle: the top left point `p1`, the top left point `p2`,
+# and a bottem left point `p3`. We can then calculate the fourth point internally.
+def create_cross_section(video_path, points, resolutions, outputName, use_cache=True):
+    source, width, height, duration = open_video(video_path, use_cache)
+    try:
+        image = render_cross_section(source, width, height, duration, points, resolutions)
+    finally:
+        close_video(source)
+    save_cross_section(image, outputName)
+
+
+# Fractions of the full sample grid rendered by each pass of a progressive export
+PROGRESSIVE_PASSES = (0.125, 0.5, 1)
+
+
+# Progressive version of `create_cross_section`: the cross-section is rendered in passes of increasing resolution (see
+# `PROGRESSIVE_PASSES`), and as soon as each pass is done a JSON message describing it is printed on its own line:
+#     {"type": "preview", "pass": 1, "passes": 3, "scale": 0.125, "width": ..., "height": ..., "path": "..."}
+# so the app can show a rough result right away, and cancel the export if it isn't what the user wanted. The final pass
+# is saved to `outputName` like a normal export; earlier passes are saved next to it as `<name>_preview<pass>.png`.
+# With `inline` set, messages carry the image itself as a PNG data URL (`"data"`) instead of a file path.
+# The video is only decoded once per export: earlier passes only sample from an evenly spaced subset of the frames the
+# final pass needs (every 8th of them for a pass at 0.125 scale, and so on), and the first pass decodes every frame the
+# final pass needs on its way through the video, keeping them in a frame cache (see `reslice_cache.py`) for the later
+# passes. Frames that don't fit in the cache's budget are simply decoded again.
+def create_progressive_cross_section(video_path, points, resolutions, outputName, passes=PROGRESSIVE_PASSES,
+                                     use_cache=True, inline=False):
+    source, width, height, duration = open_video(video_path, use_cache)
+    try:
+        plans = [plan_cross_section(width, height, duration, points, resolutions, passes[-1])]
+        for scale in passes[-2::-1]:
+            stride = max(1, round(passes[-1] / scale))
+            plans.insert(0, plan_cross_section(width, height, duration, points, resolutions, scale,
+                                               plans[-1][0].frames[::stride]))
+        # Frames that have to be decoded are shared between passes through a re-slice cache; the warm worker's own,
+        # when there is one
+        cache = reslice_cache_for(source)
+        if cache is None and isinstance(source, (cv2.VideoCapture, TimecubeReader)):
+            cache = ResliceCache()
+
+        for number, (scale, (index, image_shape)) in enumerate(zip(passes, plans), start=1):
+            read_ahead = plans[-1][0].frames if number == 1 else None
+            image = sample_cross_section(source, index, image_shape, width, height, cache, read_ahead)
+            message = {'type': 'preview', 'pass': number, 'passes': len(passes), 'scale': scale,
+                       'width': image.shape[1], 'height': image.shape[0]}
+            if number == len(passes):
+                save_cross_section(image, outputName)
+                message['path'] = os.path.abspath(outputName)
+            elif inline:
+                buffer = io.BytesIO()
+                Image.fromarray(image).save(buffer, format='PNG')
+                message['data'] = 'data:image/png;base64,' + base64.b64encode(buffer.getvalue()).decode('ascii')
+            else:
+                preview_name = f'{os.path.splitext(outputName)[0]}_preview{number}.png'
+                Image.fromarray(image).save(preview_name)
+                message['path'] = os.path.abspath(preview_name)
+            print(json.dumps(message), flush=True)
+    finally:
+        close_video(source)
+
+
 # # Example of a `create_cross_section()` function call:
 #
 # # Arrays represent top left, top right, and bottom left points of image/plane, respectively
@@ -155,246 +749,80 @@ def create_cross_section(video_path, points, resolutions, outputName):
 # create_cross_section(video, points, resolutionPercentage, output_name)
 
 
-def create_animation(video_path, points_start, points_end, resolutions, num_steps, output_base_name):
-    # Convert relative path to absolute path
-    absolute_video_path = os.path.normpath(os.path.join(os.path.dirname(os.path.abspath(__file__)), video_path))
-
-    print('Attempting to open video file at path:', absolute_video_path)
-    # Check if file exists
-    if not os.path.isfile(absolute_video_path):
-        raise Exception(f"Video file does not exist: {absolute_video_path}")
-    else:
-        print('file exists!')
-        
-    # Get the original video's dimensions and duration (in frames)
-    # print('Attempting to open video file at path:', video_path)
-    cap = cv2.VideoCapture(absolute_video_path)
-    if not cap.isOpened():
-        raise Exception("Could not open `" + absolute_video_path +  "`. Check to make sure the file actually exists, and is in .mp4 format")
-    
-    width = cap.get(cv2.CAP_PROP_FRAME_WIDTH)
-    height = cap.get(cv2.CAP_PROP_FRAME_HEIGHT)
-    duration = cap.get(cv2.CAP_PROP_FRAME_COUNT)
-
-    # Unpack corner points and resolutions
-    # Note that we only need three coordinate points to define the input rectangle: the top left point `p1`, the top left point `p2`,
-    # and a bottem left point `p3`. We can then calculate the fourth point internally.
-    # Input coordinates may be negative and/or floating-point.
+# Calculate the plane corners for every step of an animation, by linearly interpolating between the start and end
+# planes (which should already be in video space).
+def interpolate_planes(points_start, points_end, num_steps):
     p1_start, p2_start, p3_start = points_start
     p1_end, p2_end, p3_end = points_end
-    width_res, height_res = resolutions
-
-    # Convert points and resolutions from three.js space to original video space
-    # List of points
-    point_lists = [[p1_start, p2_start, p3_start], [p1_end, p2_end, p3_end]]
-    # Scaling factors
-    scaling_factors = [width / 100, height / 100, duration / 100]
-    # Scale the points
-    for point_list in point_lists:
-        for point in point_list:
-            for i in range(3):
-                point[i] *= scaling_factors[i]
-    # Make resolutions relative to plane
-    width_res = int(width_res * width / 100)
-    height_res = int(height_res * height / 100)
-
-    # Initialize a list to store pixel data and their positions for each step
-    frames_data = []
-
-    # Generate interpolated points and get pixel data
     for step in range(num_steps):
         # Calculate interpolation factor
         t = step / (num_steps - 1)
         # Interpolate points
-        p1 = [p1_start[i] * (1 - t) + p1_end[i] * t for i in range(3)]
-        p2 = [p2_start[i] * (1 - t) + p2_end[i] * t for i in range(3)]
-        p3 = [p3_start[i] * (1 - t) + p3_end[i] * t for i in range(3)]
-
-        # Calculate width and height vectors
-        width_vector = [(p2[i] - p1[i]) / width_res for i in range(3)]
-        height_vector = [(p3[i] - p1[i]) / height_res for i in range(3)]
-
-        # Initialize list for this frame's data
-        frame_data = []
-
-        # Create a list of pixel coordinates and their original positions
-        coords = []
-        for i in range(height_res):
-            for j in range(width_res):
-                # Calculate the center of the current segment
-                center = [p1[k] + (j + 0.5) * width_vector[k] + (i + 0.5) * height_vector[k] for k in range(3)]
-                center_rounded = [round(c) for c in center]
-                # Add the center and its original position to the list
-                coords.append((center_rounded, (i, j)))
-
-        # Sort the list by the z-coordinate
-        coords.sort(key=lambda n: n[0][2])
-
-        # Add the coordinates and their original positions for this step to the frames_data list
-        frames_data.append(coords)
-
-    # Now we'll get all necessary pixel data in one run as we go through the video
-    # Initialize a frame index
-    frame_index = -1
-
-    # Initialize a list to store images for each step
-    images = [np.zeros((height_res, width_res, 3)) for _ in range(num_steps)]
-
-    # Iterate over all the sorted pixel coordinates
-    for center, original_pos, step in sorted(
-            ((center, original_pos, step) for step, coords in enumerate(frames_data) for center, original_pos in
-             coords), key=lambda x: x[0][2]):
-
-        # If the frame index doesn't match with the z-coordinate of the current pixel,
-        # read frames until it does
-        while frame_index < center[2]:
-            ret, frame = cap.read()
-            if not ret:
-                raise Exception("Couldn't read video")
-            frame_index += 1
-
-        # If the coordinates are out of bounds, fill with black
-        if center[2] < 0 or center[2] >= duration or center[0] < 0 or center[0] >= width or center[1] < 0 or center[
-            1] >= height:
-            images[step][original_pos] = [0, 0, 0]
-            continue
-
-        # Convert x, y to integers as they represent pixel positions
-        x, y = map(int, center[:2])
-
-        # Add pixel color to the image for the current step at the original position
-        images[step][original_pos] = frame[y, x]
-
-    # Save the images
-    for step, image in enumerate(images):
-        # Convert BGR to RGB
-        image = cv2.cvtColor(image.astype(np.uint8), cv2.COLOR_BGR2RGB)
-
-        # Create a PIL image
-        pil_image = Image.fromarray(image)
-
-        # Save the image
-        pil_image.save(f"{output_base_name}_{step}.png")
-
-
-def create_animation_optimized(video_path, points_start, points_end, resolutions, num_steps, output_base_name):
-    # Convert relative path to absolute path
-    absolute_video_path = os.path.normpath(os.path.join(os.path.dirname(os.path.abspath(__file__)), video_path))
-
-    print('Attempting to open video file at path:', absolute_video_path)
-    # Check if file exists
-    if not os.path.isfile(absolute_video_path):
-        raise Exception(f"Video file does not exist: {absolute_video_path}")
-    else:
-        print('file exists!')
-        
-    # Get the original video's dimensions and duration (in frames)
-    # print('Attempting to open video file at path:', video_path)
-    cap = cv2.VideoCapture(absolute_video_path)
-    if not cap.isOpened():
-        raise Exception("Could not open `" + absolute_video_path +  "`. Check to make sure the file actually exists, and is in .mp4 format")
-    
-    width = cap.get(cv2.CAP_PROP_FRAME_WIDTH)
-    height = cap.get(cv2.CAP_PROP_FRAME_HEIGHT)
-    duration = cap.get(cv2.CAP_PROP_FRAME_COUNT)
-
+        p1 = p1_start * (1 - t) + p1_end * t
+        p2 = p2_start * (1 - t) + p2_end * t
+        p3 = p3_start * (1 - t) + p3_end * t
+        yield p1, p2, p3
+
+
+# Both animation functions used to have their own copy of the per-pixel loop; they now share the same sampling engine,
+# so this is kept around for anything that still calls it by its old name.
+def create_animation(video_path, points_start, points_end, resolutions, num_steps, output_base_name, use_cache=True):
+    create_animation_optimized(video_path, points_start, points_end, resolutions, num_steps, output_base_name,
+                               use_cache)
+
+
+# Render every step of an animation, yielding `(step, image)` pairs in step order, where each image is a uint8 array in
+# RGB order if `rgb` is set, or BGR otherwise. Each image is only valid until the next one is requested.
+# Steps are streamed out as soon as they're finished (see `stream_steps`), so only the steps in progress are in memory.
+# With `workers` > 1, videos that need decoding are decoded by that many processes in parallel (see
+# `sample_frames_parallel`). Cached volumes don't need decoding, so they are always sampled in this process.
+def render_animation(video_path, points_start, points_end, resolutions, num_steps, use_cache=True, workers=1,
+                     rgb=False):
+    source, width, height, duration = open_video(video_path, use_cache)
+    try:
+        index, image_shape = plan_animation(width, height, duration, points_start, points_end, resolutions, num_steps)
+
+        # Now we'll get all necessary pixel data in one run as we go through the video
+        if workers > 1 and isinstance(source, cv2.VideoCapture):
+            # Shards finish in any order, so the parallel path fills in every step before yielding any of them
+            images = np.zeros(image_shape, dtype=np.uint8)
+            sample_frames_parallel(script_relative_path(video_path), index, images, workers, rgb)
+            yield from enumerate(images)
+        else:
+            yield from stream_steps(source, index, image_shape, rgb)
+    finally:
+        close_video(source)
+
+
+# Work out which pixels every step of an animation needs, returning its `FrameSampleIndex` and the
+# `(num_steps, height_res, width_res, 3)` shape of the images to sample them into
+def plan_animation(width, height, duration, points_start, points_end, resolutions, num_steps):
     # Unpack corner points and resolutions
-    # Note that we only need three coordinate points to define the input rectangle: the top left point `p1`, the top left point `p2`,
-    # and a bottem left point `p3`. We can then calculate the fourth point internally.
+    # Note that we only need three coordinate points to define the input rectangle: the top left point `p1`, the top
+    # left point `p2`, and a bottem left point `p3`. We can then calculate the fourth point internally.
     # Input coordinates may be negative and/or floating-point.
-    p1_start, p2_start, p3_start = points_start
-    p1_end, p2_end, p3_end = points_end
-    width_res, height_res = resolutions
-
     # Convert points and resolutions from three.js space to original video space
-    # List of points
-    point_lists = [[p1_start, p2_start, p3_start], [p1_end, p2_end, p3_end]]
-    # Scaling factors
-    scaling_factors = [width / 100, height / 100, duration / 100]
-    # Scale the points
-    for point_list in point_lists:
-        for point in point_list:
-            for i in range(3):
-                point[i] *= scaling_factors[i]
-    # Make resolutions relative to plane
-    width_res = int(width_res * width / 100)
-    height_res = int(height_res * height / 100)
-
-    # Initialize a list to store pixel data and their positions for each step
-    frames_data = []
-
-    # Generate interpolated points and get pixel data
-    for step in range(num_steps):
-        # Calculate interpolation factor
-        t = step / (num_steps - 1)
-        # Interpolate points
-        p1 = [p1_start[i] * (1 - t) + p1_end[i] * t for i in range(3)]
-        p2 = [p2_start[i] * (1 - t) + p2_end[i] * t for i in range(3)]
-        p3 = [p3_start[i] * (1 - t) + p3_end[i] * t for i in range(3)]
-
-        # Calculate width and height vectors
-        width_vector = [(p2[i] - p1[i]) / width_res for i in range(3)]
-        height_vector = [(p3[i] - p1[i]) / height_res for i in range(3)]
-
-        # Initialize list for this frame's data
-        frame_data = []
-
-        # Create a list of pixel coordinates and their original positions
-        coords = []
-        # Create a list of pixel coordinates and their original positions
-        def create_coords(height_res, width_res, p1, width_vector, height_vector):
-            for i in range(height_res):
-                for j in range(width_res):
-                    center = [p1[k] + (j + 0.5) * width_vector[k] + (i + 0.5) * height_vector[k] for k in range(3)]
-                    center_rounded = [round(c) for c in center]
-                    yield (center_rounded, (i, j))
-        
-        # Create a list of pixel coordinates and their original positions
-        coords = list(create_coords(height_res, width_res, p1, width_vector, height_vector))
-
-        # Sort the list by the z-coordinate
-        coords.sort(key=lambda n: n[0][2])
-
-        # Add the coordinates and their original positions for this step to the frames_data list
-        frames_data.append(coords)
-
-    # Now we'll get all necessary pixel data in one run as we go through the video
-    # Initialize a frame index
-    frame_index = -1
-
-    # Initialize a list to store images for each step
-    images = [np.zeros((height_res, width_res, 3)) for _ in range(num_steps)]
-
-    # Iterate over all the sorted pixel coordinates
-    for center, original_pos, step in sorted(
-            ((center, original_pos, step) for step, coords in enumerate(frames_data) for center, original_pos in
-             coords), key=lambda x: x[0][2]):
-
-        # If the frame index doesn't match with the z-coordinate of the current pixel,
-        # read frames until it does
-        while frame_index < center[2]:
-            ret, frame = cap.read()
-            if not ret:
-                raise Exception("Couldn't read video")
-            frame_index += 1
-
-        # If the coordinates are out of bounds, fill with black
-        if center[2] < 0 or center[2] >= duration or center[0] < 0 or center[0] >= width or center[1] < 0 or center[
-            1] >= height:
-            images[step][original_pos] = [0, 0, 0]
-            continue
+    points_start = scale_points_to_video(points_start, width, height, duration)
+    points_end = scale_points_to_video(points_end, width, height, duration)
+    width_res, height_res = scale_resolutions_to_video(resolutions, width, height)
 
-        # Convert x, y to integers as they represent pixel positions
-        x, y = map(int, center[:2])
+    # Index the sample coordinates of every step by frame. The coordinates are generated one step at a time, so only
+    # the compact index (a few bytes per sample) is kept around.
+    corners = list(interpolate_planes(points_start, points_end, num_steps))
+    planes = (plane_sample_coordinates(p1, p2, p3, width_res, height_res) for p1, p2, p3 in corners)
+    index = build_frame_sample_index(planes, width, height, duration)
+    index.corners = corners
+    return index, (num_steps, height_res, width_res, 3)
 
-        # Add pixel color to the image for the current step at the original position
-        images[step][original_pos] = frame[y, x]
 
-    # Save the images
-    for step, image in enumerate(images):
-        # Convert BGR to RGB
-        image = cv2.cvtColor(image.astype(np.uint8), cv2.COLOR_BGR2RGB)
+# Save one animation step as a PNG (converting from OpenCV's BGR to RGB on the way, unless `rgb` says it already is)
+def save_animation_frame(image, output_base_name, step, rgb=False):
+    # Convert BGR to RGB
+    if not rgb:
+        with trace.accumulate('color'):
+            image = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
 
+    with trace.accumulate('encode'):
         # Create a PIL image
         pil_image = Image.fromarray(image)
 
@@ -402,59 +830,156 @@ def create_animation_optimized(video_path, points_start, points_end, resolutions
         pil_image.save(f"{output_base_name}_{step}.png")
 
 
-# This function turns a series of images in a folder into a video file.
-def images_to_video(image_dir, video_path, fps=24):
-    images = [img for img in os.listdir(image_dir) if img.endswith(".png")]
-
-    # Sort images by their number, not by their string representation
-    images.sort(key=lambda img: int(re.findall(r'\d+', os.path.splitext(img)[0])[0]))
-
-    # Read the first image to get the dimensions
-    frame = cv2.imread(os.path.join(image_dir, images[0]))
-    height, width, layers = frame.shape
-
-    # Create a VideoWriter object
-    fourcc = cv2.VideoWriter_fourcc(*'mp4v')
-        # Convert relative path to absolute path
-    absolute_video_path = os.path.normpath(os.path.join(os.path.dirname(os.path.abspath(__file__)), video_path))
+def create_animation_optimized(video_path, points_start, points_end, resolutions, num_steps, output_base_name,
+                               use_cache=True, workers=1):
+    # Save the images
+    for step, image in render_animation(video_path, points_start, points_end, resolutions, num_steps, use_cache,
+                                        workers, rgb=True):
+        save_animation_frame(image, output_base_name, step, rgb=True)
+
+
+# Render an animation straight into a video file, handing each finished step to a `cv2.VideoWriter` in step order
+# rather than round-tripping it through a PNG on disk. Each step is also saved as a PNG when `frame_base_name` is given.
+def create_animation_video(video_path, points_start, points_end, resolutions, num_steps, output_video_path, fps=24,
+                           frame_base_name=None, use_cache=True, workers=1):
+    steps = render_animation(video_path, points_start, points_end, resolutions, num_steps, use_cache, workers)
+    write_animation_video(steps, num_steps, output_video_path, fps, frame_base_name)
+
+
+# Encode `(step, image)` pairs (BGR uint8, in step order) into a video file (see `sequence_encoder.py`), and also save
+# them as PNGs when `frame_base_name` is given
+def write_animation_video(steps, num_steps, output_video_path, fps=24, frame_base_name=None, codec=DEFAULT_CODEC):
+    def frames():
+        for step, image in steps:
+            if frame_base_name is not None:
+                save_animation_frame(image, frame_base_name, step)
+            yield image
+
+    return encode_frames(frames(), output_video_path, fps, codec, total=num_steps)
+
+
+# Batch exports: a JSON job file lists any number of cross-sections and animations, possibly of several videos, e.g.
+#     {"jobs": [
+#         {"type": "image", "video": "clip.mp4", "points": [[...], [...], [...]], "resolutions": [100, 100],
+#          "output": "still.png"},
+#         {"type": "animation", "video": "clip.mp4", "points_start": [...], "points_end": [...],
+#          "resolutions": [50, 50], "steps": 30, "fps": 15, "output": "sweep.mp4", "frames": "sweep frames/sweep"}
+#     ]}
+# (a bare list of jobs works too). Points and resolutions are in three.js space, like the other exports. Animations are
+# written to `output` as a video (with the FourCC `codec`, `mp4v` by default), and also saved as `<frames>_<step>.png`
+# when `frames` is given.
+# Relative paths are relative to the job file.
+# Jobs are grouped by video, and each video's source is opened once for all of its jobs. Its images are sampled
+# together, in a single pass through the video; each animation is then streamed straight into its outputs step by step
+# (see `stream_steps`), so no animation is ever held in memory as a whole. Outputs are written in job order.
+BATCH_JOB_TYPES = ('image', 'animation')
+
+
+def run_batch(job_file, use_cache=True):
+    with open(job_file) as f:
+        spec = json.load(f)
+    jobs = spec['jobs'] if isinstance(spec, dict) else spec
+    job_dir = os.path.dirname(os.path.abspath(job_file))
+
+    def job_path(path):
+        return os.path.join(job_dir, path)
+
+    # Group the jobs by video, keeping them in job order
+    jobs_by_video = OrderedDict()
+    for number, job in enumerate(jobs):
+        if job.get('type') not in BATCH_JOB_TYPES:
+            raise Exception(f"Job {number}: unknown type `{job.get('type')}` (expected one of {BATCH_JOB_TYPES})")
+        if job['type'] == 'image' and job.get('output') is None:
+            raise Exception(f"Job {number}: images need an `output` path")
+        if job['type'] == 'animation' and job.get('output') is None and job.get('frames') is None:
+            raise Exception(f"Job {number}: animations need an `output` video path and/or a `frames` base name")
+        steps = job.get('steps', 30)
+        if job['type'] == 'animation' and not (isinstance(steps, int) and steps >= 2):
+            raise Exception(f"Job {number}: animations need at least 2 `steps`, got {steps!r}")
+        jobs_by_video.setdefault(os.path.abspath(job_path(job['video'])), []).append((number, job))
+
+    for video_path, video_jobs in jobs_by_video.items():
+        print(f'Batch: {len(video_jobs)} job(s) for {video_path}')
+        source, width, height, duration = open_video(video_path, use_cache)
+        try:
+            # Index every job's samples before decoding anything, so a bad job fails the batch up front
+            plans = []
+            for number, job in video_jobs:
+                if job['type'] == 'image':
+                    plans.append(plan_cross_section(width, height, duration, job['points'], job['resolutions']))
+                else:
+                    plans.append(plan_animation(width, height, duration, job['points_start'], job['points_end'],
+                                                job['resolutions'], job.get('steps', 30)))
+
+            # Images are small, so sample them all (in RGB) in one pass
+            images = {number: (index, np.zeros(image_shape, dtype=np.uint8), True)
+                      for (number, job), (index, image_shape) in zip(video_jobs, plans) if job['type'] == 'image'}
+            if images:
+                sample_frames_batch(source, list(images.values()))
+
+            for (number, job), (index, image_shape) in zip(video_jobs, plans):
+                if job['type'] == 'image':
+                    save_cross_section(images.pop(number)[1][0], job_path(job['output']))
+                elif job.get('output') is not None:
+                    # Anything going into a video stays BGR
+                    frame_base_name = job_path(job['frames']) if job.get('frames') is not None else None
+                    write_animation_video(stream_steps(source, index, image_shape), image_shape[0],
+                                          job_path(job['output']), job.get('fps', 24), frame_base_name,
+                                          job.get('codec', DEFAULT_CODEC))
+                else:
+                    for step, image in stream_steps(source, index, image_shape, rgb=True):
+                        save_animation_frame(image, job_path(job['frames']), step, rgb=True)
+                print(f"Batch: finished job {number} ({job['type']})")
+        finally:
+            close_video(source)
+
+
+# Handle one export, given the same arguments the script takes on the command line (without the script name):
+# `[type_of_export, video_path, points, resolutions]`, plus `points_end` for video exports. Points and resolutions are
+# JSON strings. Batch exports take `[BatchExport, job_file]` instead (see `run_batch`).
+# Pass `--trace` (or set `TIMECUBE_TRACE=1`) to print per-stage timings, progress and a summary as JSON lines (see
+# `export_instrumentation.py`), and set `TIMECUBE_PROFILE=1` to print the 20 slowest functions according to cProfile.
+def run_export(args):
+    if '--trace' in args:
+        args = [arg for arg in args if arg != '--trace']
+        trace.enable()
+    trace.reset()
+    profiler = None
+    if os.environ.get('TIMECUBE_PROFILE', '0') == '1':
+        profiler = cProfile.Profile()
+        profiler.enable()
 
-    video = cv2.VideoWriter(absolute_video_path, fourcc, fps, (width, height))
+    print('Starting python script...')
+    type_of_export = args[0]  # first argument
+    if type_of_export == 'BatchExport':
+        run_batch(args[1])
+    else:
+        _run_single_export(type_of_export, args)
 
-    for image in images:
-        frame = cv2.imread(os.path.join(image_dir, image))
-        video.write(frame)
+    if profiler is not None:
+        profiler.disable()
+        s = io.StringIO()
+        # 'tottime' refers to the total time spent in the function itself
+        ps = pstats.Stats(profiler, stream=s).sort_stats('tottime')
+        ps.print_stats(20)  # Change this number to control how many lines are printed
+        print(s.getvalue())
 
-    # Release the VideoWriter object
-    video.release()
+    trace.summary(export=type_of_export)
+    print('Finished!')
 
-# Example function call:
 
-# image_dir = '3D creations\output_frames'
-# video_path = 'output_frames from video.mp4'
-# fps = 24  # Set the desired frames per second for the output video
-#
-# images_to_video(image_dir, video_path, fps)
-
-if __name__ == "__main__":
-    print('Starting python script...')
-    type_of_export = sys.argv[1]  # first argument
-    video_path = sys.argv[2]  # second argument
-    points = json.loads(sys.argv[3])  # third argument
-    resolutions = json.loads(sys.argv[4])  # fourth argument
+def _run_single_export(type_of_export, args):
+    video_path = args[1]  # second argument
+    points = json.loads(args[2])  # third argument
+    resolutions = json.loads(args[3])  # fourth argument
     output_name = 'cross_section_of_TIMECUBE.png'
     # Parse the arguments if necessary, then pass them to your function
     if type_of_export == 'ImageExport':
         create_cross_section(video_path, points, resolutions, output_name)
+    elif type_of_export == 'ProgressiveImageExport':
+        create_progressive_cross_section(video_path, points, resolutions, output_name)
     else:
         print('Running video export function!')
-        # Create directory for output images to go in
-        subdirectory = 'timecube animation subfolder'
-        # check if directory exists, and if it doesn't, we create a new path
-        try:
-            os.makedirs(subdirectory)
-        except FileExistsError:
-            # directory already exists
-            pass
 
         # Arrays represent top left, top right, and bottom left points of image/plane, respectively
         # points_start = [[0, 2.011826308353337, 38.82721897763515], [100, 2.011826308353337, 38.82721897763515],
@@ -462,38 +987,86 @@ if __name__ == "__main__":
         # points_end = [[0, 62.14330284160403, 8.44574085109614], [100, 62.14330284160403, 8.44574085109614],
         #             [0, 96.87672258600332, 99.46181904906989]]
         points_start = points
-        points_end = json.loads(sys.argv[5])
+        points_end = json.loads(args[4])
 
         resolutionPercentage = [50, 50]  # percent (out of 100) resolution of image's width and height
 
-        video = "C:/Users/yitzi/Downloads/ezgif.com-gif-to-mp4.mp4"
         print('input video path is: ' + video_path)
         # 'C:/Users/yitzi/Videos/new slitscan/pexels-naveen-g-4190998-1920x1080-25fps.mp4' #girls dancing
-        output_name = os.path.join(subdirectory, 'timecube animation')
         numberOfFrames = 30
-        image_dir = subdirectory
         timestamp = datetime.datetime.now().strftime("%Y%m%d-%H%M%S")
         output_video_path = f'../dist/video output/TIMESLICED output {timestamp}.mp4'
         print('output video path is: ' + output_video_path)
         fps = 15  # Set the desired frames per second for the output video
 
-        pr = cProfile.Profile() #this is for profiling
-        pr.enable() #this is for profiling
+        # The animation's frames are streamed straight into the video. Set the `TIMECUBE_SAVE_ANIMATION_FRAMES`
+        # environment variable to 1 to also keep each frame as a PNG in a subdirectory.
+        frame_base_name = None
+        if os.environ.get('TIMECUBE_SAVE_ANIMATION_FRAMES', '0') == '1':
+            # Create directory for output images to go in
+            subdirectory = 'timecube animation subfolder'
+            os.makedirs(subdirectory, exist_ok=True)
+            frame_base_name = os.path.join(subdirectory, 'timecube animation')
+
+        # Number of processes to decode the video with (only used when the video isn't in the volume cache)
+        workers = int(os.environ.get('TIMECUBE_WORKERS', '1'))
+
+        # Render the animation and encode it as a video
+        create_animation_video(video_path, points_start, points_end, resolutionPercentage, numberOfFrames,
+                               script_relative_path(output_video_path), fps, frame_base_name, workers=workers)
+
+
+# Writes everything printed during a worker request both to a buffer (returned with the response) and to stderr (so it
+# still shows up live in the Electron console), keeping stdout free for the JSON protocol.
+class _RequestLog(io.StringIO):
+    def write(self, text):
+        sys.stderr.write(text)
+        return super().write(text)
+
+
+# Resident worker mode (`python takeVideoCrossSection.py worker`), so the app only pays for interpreter startup and
+# importing cv2/numpy/PIL once, rather than on every export.
+# Requests are read from stdin, one JSON object per line: `{"id": ..., "args": [...]}`, where `args` are the usual
+# command-line arguments. Requests are handled one after another, and each gets a single JSON line back on stdout:
+# `{"id": ..., "ok": true, "output": [printed lines]}`, or `{"id": ..., "ok": false, "error": "...", "output": [...]}`.
+# Send `{"type": "shutdown"}` (or close stdin) to stop the worker.
+def run_worker(stdin=sys.stdin, stdout=sys.stdout):
+    keep_sources_warm()
+    trace_by_default = trace.enabled
+    for line in stdin:
+        if not line.strip():
+            continue
+        try:
+            request = json.loads(line)
+        except ValueError as e:
+            response = {'id': None, 'ok': False, 'error': f'Invalid request: {e}', 'output': []}
+            stdout.write(json.dumps(response) + '\n')
+            stdout.flush()
+            continue
 
-        # Run function to output our images in a given subdirectory
-        create_animation_optimized(video_path, points_start, points_end, resolutionPercentage, numberOfFrames, output_name)
+        request_id = request.get('id')
+        if request.get('type') == 'shutdown':
+            stdout.write(json.dumps({'id': request_id, 'ok': True, 'output': []}) + '\n')
+            stdout.flush()
+            break
 
+        # Requests can ask for tracing with `"trace": true`
+        trace.enable(request.get('trace', trace_by_default))
+        log = _RequestLog()
+        try:
+            with contextlib.redirect_stdout(log):
+                run_export(request['args'])
+            response = {'id': request_id, 'ok': True, 'output': log.getvalue().splitlines()}
+        except Exception as e:
+            response = {'id': request_id, 'ok': False, 'error': str(e), 'output': log.getvalue().splitlines()}
+        stdout.write(json.dumps(response) + '\n')
+        stdout.flush()
+    close_warm_sources()
 
-        # This bit is for profiling the code; comment out before release
-        pr.disable()
-        s = io.StringIO()
-        ps = pstats.Stats(pr, stream=s).sort_stats('tottime')  # 'tottime' refers to the total time spent in the function itself
-        ps.print_stats(20)  # Change this number to control how many lines are printed
-        print(s.getvalue())
-        # End of profiling code segment
 
-        # Turn images into video (remember to delete the folder with all the images, if you don't want that)
-        images_to_video(image_dir, output_video_path, fps)
-    
-    print('Finished!')
+if __name__ == "__main__":
+    if sys.argv[1] == 'worker':
+        run_worker()
+    else:
+        run_export(sys.argv[1:])
     sys.exit()
@@ -0,0 +1,45 @@
+# Regression tests for `reslice_cache.py`. Run with `python -m pytest`, from this folder or the repository root.
+import numpy as np
+
+from reslice_cache import ResliceCache
+
+
+def _pixels(keys):
+    return np.repeat(np.asarray(keys)[:, np.newaxis], 3, axis=1).astype(np.uint8)
+
+
+def _cache_with_requests(*requests):
+    cache = ResliceCache(budget_bytes=1 << 20)
+    for keys in requests:
+        cache.add_samples(np.array(keys), _pixels(keys))
+    return cache
+
+
+# Hits in older requests move them to the end of the LRU while `lookup` is still going through the requests
+def test_lookup_hits_in_several_older_requests():
+    cache = _cache_with_requests([1, 2, 3], [4, 5, 6], [7, 8, 9])
+    keys = np.array([3, 5, 9, 42])
+    values = np.zeros((keys.size, 3), dtype=np.uint8)
+    found = cache.lookup(keys, values)
+    assert found.tolist() == [True, True, True, False]
+    assert np.array_equal(values[:3], _pixels([3, 5, 9]))
+
+
+def test_lookup_marks_hit_requests_as_recently_used():
+    cache = _cache_with_requests([1, 2, 3], [4, 5, 6], [7, 8, 9])
+    cache.max_requests = 3
+    cache.lookup(np.array([2]), np.zeros((1, 3), dtype=np.uint8))
+    # The request holding key 2 was used last, so adding a fourth request evicts the one holding 4-6 instead
+    cache.add_samples(np.array([10]), _pixels([10]))
+    values = np.zeros((3, 3), dtype=np.uint8)
+    assert cache.lookup(np.array([2, 5, 10]), values).tolist() == [True, False, True]
+
+
+# Shrinking the budget (when another warm video gets a cache) evicts the least recently used frames right away
+def test_set_budget_evicts_frames():
+    frame = np.zeros((10, 10, 3), dtype=np.uint8)
+    cache = ResliceCache(budget_bytes=frame.nbytes * 8)
+    for frame_index in range(6):
+        cache.add_frame(frame_index, frame.copy())
+    cache.set_budget(frame.nbytes * 4)
+    assert [frame_index for frame_index in range(6) if cache.get_frame(frame_index) is not None] == [3, 4, 5]
@@ -0,0 +1,273 @@
+# Reader and writer for binary `.timecube` files, which store a whole video volume in a form that can be partially read.
+#
+# File layout (all integers little-endian):
+#     header    8 bytes   magic `TIMECUBE`
+#               4 bytes   uint32 format version (currently 1)
+#     chunks    zlib-compressed runs of consecutive frames. Each chunk holds `frame_count` frames of raw
+#               `(height, width, 3)` uint8 BGR pixels, one after another.
+#     metadata  UTF-8 JSON object (see below)
+#     index     one 24-byte entry per chunk, in frame order: uint32 first_frame, uint32 frame_count,
+#               uint64 offset of the compressed chunk from the start of the file, uint64 compressed size
+#     footer    8 bytes   uint64 offset of the metadata
+#               8 bytes   uint64 length of the metadata
+#               8 bytes   uint64 offset of the index
+#               4 bytes   uint32 number of chunks
+#               4 bytes   magic `TCFT`
+#
+# The metadata and index are written at the end so that frames can be streamed in without knowing the frame count in
+# advance. The metadata holds:
+#     width, height, frames   dimensions of the stored volume
+#     fps                     frame rate of the source video
+#     channel_order           always "BGR", the order OpenCV decodes frames in
+#     source                  path of the video the volume was made from, and its original width/height/frame count
+#     coordinate_scale        factors that turn three.js-space coordinates (0-100 along every axis) into volume space,
+#                             i.e. `[width / 100, height / 100, frames / 100]`
+#
+# Readers only decompress the chunks that hold the frames they ask for, so a TIMEKNIFE slice only pays for the frame
+# ranges its plane actually touches. `TimecubeReader` can be used anywhere the slicing code expects a decoded volume.
+#
+# The other volume formats (`.tcbricks`, see `brick_volume.py`, and `.tcdelta`, see `delta_volume.py`) use the same
+# container, each with its own magics, payload, index entries and extra metadata; the functions below that read and
+# write the container are shared with them.
+#
+# Run this file directly to convert a video:
+#     python timecube_format.py "../dist/timecube_models/man walking to bench.mp4" "man walking to bench.timecube"
+import argparse
+import json
+import os
+import struct
+import zlib
+from collections import OrderedDict
+
+import cv2
+import numpy as np
+
+from video_capture import open_capture
+from video_to_ply import iter_video_frames, output_size, prepare_frame
+
+MAGIC = b'TIMECUBE'
+FOOTER_MAGIC = b'TCFT'
+VERSION = 1
+HEADER = struct.Struct('<8sI')
+FOOTER = struct.Struct('<QQQI4s')
+INDEX_DTYPE = np.dtype([('first_frame', '<u4'), ('frame_count', '<u4'), ('offset', '<u8'), ('size', '<u8')])
+
+
+# Metadata of a volume with the given dimensions, with any format-specific entries (`extra`) after the frame rate
+def volume_metadata(width, height, num_frames, fps, source, **extra):
+    return {
+        'width': width,
+        'height': height,
+        'frames': num_frames,
+        'fps': fps,
+        **extra,
+        'channel_order': 'BGR',
+        'source': source,
+        'coordinate_scale': [width / 100, height / 100, num_frames / 100],
+    }
+
+
+def check_frame(frame, width, height):
+    if frame.shape != (height, width, 3) or frame.dtype != np.uint8:
+        raise Exception(f"Frame of shape {frame.shape} doesn't match the volume's {(height, width, 3)}")
+
+
+# Create a new container at `path`, returning it opened for writing its payload
+def create_container(path, magic, version):
+    file = open(path, 'wb')
+    file.write(HEADER.pack(magic, version))
+    return file
+
+
+# Finish a container whose payload has just been written to `file`: write the metadata, the `index` (a list of tuples
+# matching `index_dtype`) and the footer, then close the file
+def write_trailer(file, metadata, index, index_dtype, footer_magic):
+    metadata_bytes = json.dumps(metadata).encode('utf-8')
+    metadata_offset = file.tell()
+    file.write(metadata_bytes)
+    index_offset = file.tell()
+    file.write(np.array(index, dtype=index_dtype).tobytes())
+    file.write(FOOTER.pack(metadata_offset, len(metadata_bytes), index_offset, len(index), footer_magic))
+    file.close()
+
+
+# Check the header of a container opened as `file`, and return its metadata and index. `extension` is only used in
+# error messages.
+def read_container(file, path, magic, footer_magic, version, index_dtype, extension):
+    file_magic, file_version = HEADER.unpack(file.read(HEADER.size))
+    if file_magic != magic:
+        raise Exception(f"`{path}` is not a {extension} file")
+    if file_version > version:
+        raise Exception(f"`{path}` uses {extension} format version {file_version}, which is newer than this reader")
+
+    file.seek(-FOOTER.size, os.SEEK_END)
+    metadata_offset, metadata_length, index_offset, num_entries, file_footer_magic = \
+        FOOTER.unpack(file.read(FOOTER.size))
+    if file_footer_magic != footer_magic:
+        raise Exception(f"`{path}` is truncated or corrupt")
+    file.seek(metadata_offset)
+    metadata = json.loads(file.read(metadata_length).decode('utf-8'))
+    file.seek(index_offset)
+    index = np.frombuffer(file.read(num_entries * index_dtype.itemsize), dtype=index_dtype)
+    return metadata, index
+
+
+# Open the video at `video_path` for converting into a volume, returning the capture, the size its frames should be
+# converted to (see `output_size`) and the `source` entry of the volume's metadata
+def open_source_video(video_path, width=None, height=None, scale=None):
+    cap = open_capture(video_path)
+    source_width = int(cap.get(cv2.CAP_PROP_FRAME_WIDTH))
+    source_height = int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
+    size = output_size(source_width, source_height, width, height, scale) or (source_width, source_height)
+    source = {'path': os.path.abspath(video_path), 'width': source_width, 'height': source_height,
+              'frames': int(cap.get(cv2.CAP_PROP_FRAME_COUNT))}
+    return cap, size, source
+
+
+# Write every frame `cap` still has to give into a volume writer, resized to `size`
+def write_video_frames(cap, writer, size=None):
+    for _, frame in iter_video_frames(cap):
+        writer.write_frame(prepare_frame(frame, size))
+
+
+# Command-line arguments shared by the video-to-volume converters; each adds its own format's options
+def conversion_argument_parser(description):
+    parser = argparse.ArgumentParser(description=description)
+    parser.add_argument('video_path')
+    parser.add_argument('output_path', nargs='?', help='defaults to the video path with the extension replaced')
+    parser.add_argument('--width', type=int, help='resize frames to this width')
+    parser.add_argument('--height', type=int, help='resize frames to this height')
+    parser.add_argument('--scale', type=float, help='resize frames by this factor')
+    return parser
+
+
+# Streams frames into a new .timecube file, `frames_per_chunk` frames per compressed chunk.
+# Use as a context manager, or call `close()` when done so the metadata and index get written.
+class TimecubeWriter:
+    def __init__(self, path, width, height, fps=0, frames_per_chunk=8, compression_level=1, source=None):
+        self.path = path
+        self.width = width
+        self.height = height
+        self.fps = fps
+        self.frames_per_chunk = frames_per_chunk
+        self.compression_level = compression_level
+        self.source = source or {}
+        self.num_frames = 0
+        self._index = []
+        self._pending = []
+        self._file = create_container(path, MAGIC, VERSION)
+
+    def write_frame(self, frame):
+        check_frame(frame, self.width, self.height)
+        self._pending.append(np.ascontiguousarray(frame))
+        if len(self._pending) == self.frames_per_chunk:
+            self._flush()
+
+    def _flush(self):
+        if not self._pending:
+            return
+        data = zlib.compress(b''.join(frame.tobytes() for frame in self._pending), self.compression_level)
+        self._index.append((self.num_frames, len(self._pending), self._file.tell(), len(data)))
+        self._file.write(data)
+        self.num_frames += len(self._pending)
+        self._pending = []
+
+    def close(self):
+        if self._file.closed:
+            return
+        self._flush()
+        write_trailer(self._file, volume_metadata(self.width, self.height, self.num_frames, self.fps, self.source),
+                      self._index, INDEX_DTYPE, FOOTER_MAGIC)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+# Read-only access to a .timecube file. Indexing with a frame number (`reader[frame_index]`) returns that frame as a
+# `(height, width, 3)` BGR uint8 array, so a reader can stand in for a decoded volume. The most recently decompressed
+# chunks are kept in a small LRU, so reading frames in order decompresses each chunk only once.
+class TimecubeReader:
+    def __init__(self, path, cached_chunks=4):
+        self.path = path
+        self._file = open(path, 'rb')
+        self.metadata, self.index = read_container(self._file, path, MAGIC, FOOTER_MAGIC, VERSION, INDEX_DTYPE,
+                                                   '.timecube')
+
+        self.shape = (self.metadata['frames'], self.metadata['height'], self.metadata['width'], 3)
+        self.fps = self.metadata['fps']
+        self._chunk_starts = self.index['first_frame'].astype(np.int64)
+        self._cached_chunks = cached_chunks
+        self._chunks = OrderedDict()
+
+    def __len__(self):
+        return self.shape[0]
+
+    # Index of the chunk holding `frame_index`
+    def chunk_of(self, frame_index):
+        return int(np.searchsorted(self._chunk_starts, frame_index, side='right')) - 1
+
+    def read_chunk(self, chunk):
+        if chunk in self._chunks:
+            self._chunks.move_to_end(chunk)
+            return self._chunks[chunk]
+        first_frame, frame_count, offset, size = self.index[chunk]
+        self._file.seek(int(offset))
+        data = zlib.decompress(self._file.read(int(size)))
+        frames = np.frombuffer(data, dtype=np.uint8).reshape((int(frame_count),) + self.shape[1:])
+        self._chunks[chunk] = frames
+        while len(self._chunks) > self._cached_chunks:
+            self._chunks.popitem(last=False)
+        return frames
+
+    def __getitem__(self, frame_index):
+        frame_index = int(frame_index)
+        if frame_index < 0 or frame_index >= self.shape[0]:
+            raise IndexError(f'Frame {frame_index} is outside of the volume (0-{self.shape[0] - 1})')
+        chunk = self.chunk_of(frame_index)
+        return self.read_chunk(chunk)[frame_index - self._chunk_starts[chunk]]
+
+    # Read frames `start` up to (not including) `stop` into one `(stop - start, height, width, 3)` array, only touching
+    # the chunks that overlap that range
+    def read_frames(self, start, stop):
+        start, stop = max(0, start), min(self.shape[0], stop)
+        frames = np.empty((max(0, stop - start),) + self.shape[1:], dtype=np.uint8)
+        for frame_index in range(start, stop):
+            frames[frame_index - start] = self[frame_index]
+        return frames
+
+    def close(self):
+        self._chunks.clear()
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def video_to_timecube(video_path, output_path, width=None, height=None, scale=None, frames_per_chunk=8,
+                      compression_level=1):
+    cap, size, source = open_source_video(video_path, width, height, scale)
+    try:
+        with TimecubeWriter(output_path, size[0], size[1], cap.get(cv2.CAP_PROP_FPS), frames_per_chunk,
+                            compression_level, source) as writer:
+            write_video_frames(cap, writer, size)
+    finally:
+        cap.release()
+
+    print(f'Wrote {writer.num_frames} frames ({size[0]}x{size[1]}) to {output_path}')
+    return output_path
+
+
+if __name__ == "__main__":
+    parser = conversion_argument_parser('Convert a video into a .timecube file.')
+    parser.add_argument('--frames-per-chunk', type=int, default=8)
+    parser.add_argument('--compression-level', type=int, default=1, help='zlib compression level (0-9)')
+    args = parser.parse_args()
+
+    video_to_timecube(args.video_path, args.output_path or os.path.splitext(args.video_path)[0] + '.timecube',
+                      args.width, args.height, args.scale, args.frames_per_chunk, args.compression_level)
@@ -0,0 +1,33 @@
+# Opening and seeking `cv2.VideoCapture`s, shared by everything that decodes videos directly.
+import cv2
+
+# Captures (by `id()`) whose container turned out not to seek accurately. They are only ever read forward from then on,
+# going back to the beginning when an earlier frame is needed.
+unseekable_captures = set()
+
+
+def open_capture(video_path):
+    cap = cv2.VideoCapture(video_path)
+    if not cap.isOpened():
+        raise Exception("Could not open `" + video_path + "`. Check to make sure the file actually exists, and is in "
+                        ".mp4 format")
+    return cap
+
+
+def release_capture(cap):
+    unseekable_captures.discard(id(cap))
+    cap.release()
+
+
+# Move `cap` so that the next frame it decodes is `frame_index`, returning the position it actually ended up at
+def seek_video(cap, frame_index):
+    if id(cap) not in unseekable_captures:
+        cap.set(cv2.CAP_PROP_POS_FRAMES, frame_index)
+        position = int(cap.get(cv2.CAP_PROP_POS_FRAMES))
+        if position == frame_index:
+            return position
+        # Some containers can't seek accurately; start again from the beginning and skip forward instead, and don't
+        # try seeking this capture again
+        unseekable_captures.add(id(cap))
+    cap.set(cv2.CAP_PROP_POS_FRAMES, 0)
+    return 0
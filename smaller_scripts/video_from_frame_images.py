@@ -1,29 +1,11 @@
 # This script turns a series of images in a folder into a video file.
-import cv2
-import os
-import re
+from sequence_encoder import DEFAULT_CODEC, encode_image_sequence
 
 
-def images_to_video(image_dir, video_path, fps=24):
-    images = [img for img in os.listdir(image_dir) if img.endswith(".png")]
-
-    # Sort images by their number, not by their string representation
-    images.sort(key=lambda img: int(re.findall(r'\d+', os.path.splitext(img)[0])[0]))
-
-    # Read the first image to get the dimensions
-    frame = cv2.imread(os.path.join(image_dir, images[0]))
-    height, width, layers = frame.shape
-
-    # Create a VideoWriter object
-    fourcc = cv2.VideoWriter_fourcc(*'mp4v')
-    video = cv2.VideoWriter(video_path, fourcc, fps, (width, height))
-
-    for image in images:
-        frame = cv2.imread(os.path.join(image_dir, image))
-        video.write(frame)
-
-    # Release the VideoWriter object
-    video.release()
+# The images are decoded ahead of the writer by a pool of threads (see `sequence_encoder.py`, which can also be run
+# directly from the command line)
+def images_to_video(image_dir, video_path, fps=24, codec=DEFAULT_CODEC):
+    return encode_image_sequence(image_dir, video_path, fps, codec)
 
 # Example function call:
 
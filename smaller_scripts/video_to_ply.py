@@ -0,0 +1,126 @@
+# Turns a video file into a TIMECUBE .ply point cloud, entirely in Python.
+#     Frames are streamed straight from `cv2.VideoCapture` (no PNG dump of every frame first), optionally resized and
+#     subsampled, and written out in fixed-size chunks, so memory use stays the same no matter how long the video is.
+#     Points use the same layout as `resizeAndPlyify.js`: each pixel becomes a point at `[x, y - 1, frame]` with its
+#     RGB color.
+#     The body is written as `binary_little_endian` by default; pass `--ascii` for the old ASCII layout.
+#     Pass `--index` to also build the cloud's luminance/color index (see `luminance_index.py`).
+#
+# Example:
+#     python video_to_ply.py "../dist/timecube_models/man walking to bench.mp4" "man walking to bench.ply" --height 100
+import argparse
+import os
+
+import cv2
+import numpy as np
+
+from ply_io import PlyWriter, VERTEX_DTYPE
+from video_capture import open_capture, seek_video
+
+
+# Work out the size frames should be resized to. Either dimension may be given on its own, in which case the other one
+# keeps the video's aspect ratio; `scale` multiplies both. Returns None when frames should be left as they are.
+def output_size(width, height, target_width=None, target_height=None, scale=None):
+    if target_width is None and target_height is None and scale is None:
+        return None
+    if scale is not None:
+        target_width, target_height = width * scale, height * scale
+    elif target_width is None:
+        target_width = width * target_height / height
+    elif target_height is None:
+        target_height = height * target_width / width
+    return max(1, int(round(target_width))), max(1, int(round(target_height)))
+
+
+# Yield every `frame_step`th frame of the video (between `start_frame` and `end_frame`), as `(frame_index, frame)`
+# pairs. Frames in between are only grabbed, never converted.
+def iter_video_frames(cap, frame_step=1, start_frame=0, end_frame=None):
+    frame_index = seek_video(cap, start_frame) if start_frame else 0
+    # If the container couldn't seek there, skip forward to it instead
+    while frame_index < start_frame:
+        if not cap.grab():
+            return
+        frame_index += 1
+    while end_frame is None or frame_index < end_frame:
+        if (frame_index - start_frame) % frame_step == 0:
+            ret, frame = cap.read()
+            if not ret:
+                return
+            yield frame_index, frame
+        elif not cap.grab():
+            return
+        frame_index += 1
+
+
+# Convert one (already resized and subsampled) BGR frame into TIMECUBE vertices at depth `z`.
+# `vertices` is a preallocated buffer whose x/y coordinates have already been filled in.
+def frame_to_vertices(frame, z, vertices):
+    vertices['z'] = z
+    vertices['red'] = frame[..., 2].ravel()
+    vertices['green'] = frame[..., 1].ravel()
+    vertices['blue'] = frame[..., 0].ravel()
+    return vertices
+
+
+# Point grid for frames of the given size, following `resizeAndPlyify.js` (`[x, y - 1, depth]`)
+def vertex_grid(width, height):
+    vertices = np.zeros(width * height, dtype=VERTEX_DTYPE)
+    ys, xs = np.mgrid[0:height, 0:width]
+    vertices['x'] = xs.ravel()
+    vertices['y'] = ys.ravel() - 1
+    return vertices
+
+
+# Prepare a frame for conversion: resize it to `size` (if given), then keep every `pixel_step`th pixel along both axes
+def prepare_frame(frame, size=None, pixel_step=1):
+    if size is not None and size != (frame.shape[1], frame.shape[0]):
+        frame = cv2.resize(frame, size, interpolation=cv2.INTER_AREA)
+    if pixel_step > 1:
+        frame = frame[::pixel_step, ::pixel_step]
+    return frame
+
+
+def video_to_ply(video_path, output_path, width=None, height=None, scale=None, frame_step=1, pixel_step=1,
+                 start_frame=0, end_frame=None, binary=True, chunk_size=1 << 20):
+    cap = open_capture(video_path)
+
+    size = output_size(cap.get(cv2.CAP_PROP_FRAME_WIDTH), cap.get(cv2.CAP_PROP_FRAME_HEIGHT), width, height, scale)
+    vertices = None
+    depth = 0
+    try:
+        with PlyWriter(output_path, binary, chunk_size) as writer:
+            for _, frame in iter_video_frames(cap, frame_step, start_frame, end_frame):
+                frame = prepare_frame(frame, size, pixel_step)
+                if vertices is None:
+                    vertices = vertex_grid(frame.shape[1], frame.shape[0])
+                writer.write(frame_to_vertices(frame, depth, vertices))
+                depth += 1
+    finally:
+        cap.release()
+
+    print(f'Wrote {writer.num_vertices} points ({depth} frames) to {output_path}')
+    return output_path
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Convert a video into a TIMECUBE .ply point cloud.')
+    parser.add_argument('video_path')
+    parser.add_argument('output_path', nargs='?', help='defaults to the video path with .ply appended')
+    parser.add_argument('--width', type=int, help='resize frames to this width')
+    parser.add_argument('--height', type=int, help='resize frames to this height')
+    parser.add_argument('--scale', type=float, help='resize frames by this factor')
+    parser.add_argument('--frame-step', type=int, default=1, help='only keep every Nth frame')
+    parser.add_argument('--pixel-step', type=int, default=1, help='only keep every Nth pixel along x and y')
+    parser.add_argument('--start-frame', type=int, default=0)
+    parser.add_argument('--end-frame', type=int)
+    parser.add_argument('--ascii', action='store_true', help='write an ASCII .ply instead of binary_little_endian')
+    parser.add_argument('--index', action='store_true',
+                        help='also build a .lumindex luminance/color index of the points')
+    args = parser.parse_args()
+
+    output_path = video_to_ply(args.video_path, args.output_path or os.path.abspath(args.video_path) + '.ply',
+                               args.width, args.height, args.scale, args.frame_step, args.pixel_step,
+                               args.start_frame, args.end_frame, binary=not args.ascii)
+    if args.index:
+        from luminance_index import build_index
+        build_index(output_path)
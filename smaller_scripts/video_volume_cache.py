@@ -0,0 +1,229 @@
+# This script keeps a cache of decoded videos on disk, so that slicing the same video again doesn't mean decoding it
+# again:
+#     The second time a video is requested, every frame is decoded once into a memory-mapped
+#     `(frames, height, width, 3)` uint8 volume (BGR, exactly like the frames `cv2.VideoCapture` hands back), stored as
+#     a `.npy` file. The first request only leaves a marker behind, so a video that is only ever sliced once (and the
+#     first slice of every video) is decoded directly, only up to the frames it needs, without waiting on a full decode.
+#     Volumes are keyed by the video's absolute path, size and modification time, so editing or replacing a video
+#     automatically invalidates its old volume.
+#     The cache has a size budget; when a new volume doesn't fit, the least recently used volumes are deleted first.
+#     Setting `TIMECUBE_CACHE_FORMAT` to `delta` stores volumes as lossless `.tcdelta` files instead (see
+#     `delta_volume.py`), which take up a fraction of the space for static-camera videos. Those are loaded as a
+#     `DeltaVolumeReader` rather than as an array.
+#
+# The cache folder and budget can be changed with the `TIMECUBE_CACHE_DIR` and `TIMECUBE_CACHE_BUDGET_MB` environment
+# variables. Run this file directly to pre-build, list or clear cached volumes.
+import hashlib
+import json
+import os
+import sys
+import time
+
+import cv2
+import numpy as np
+
+import delta_volume
+from video_capture import open_capture
+
+DEFAULT_CACHE_DIR = os.path.join(os.path.expanduser('~'), '.timecube', 'volume_cache')
+DEFAULT_BUDGET_MB = 8 * 1024
+# File extension of the volumes of each cache format
+VOLUME_EXTENSIONS = {'npy': '.npy', 'delta': '.tcdelta'}
+
+
+def get_cache_dir():
+    return os.environ.get('TIMECUBE_CACHE_DIR', DEFAULT_CACHE_DIR)
+
+
+def get_budget_bytes():
+    return int(float(os.environ.get('TIMECUBE_CACHE_BUDGET_MB', DEFAULT_BUDGET_MB)) * 1024 * 1024)
+
+
+def get_volume_format():
+    volume_format = os.environ.get('TIMECUBE_CACHE_FORMAT', 'npy')
+    if volume_format not in VOLUME_EXTENSIONS:
+        raise Exception(f"Unknown TIMECUBE_CACHE_FORMAT `{volume_format}` (expected one of {list(VOLUME_EXTENSIONS)})")
+    return volume_format
+
+
+# Key identifying one particular version of a video file, cached in the given format
+def cache_key(absolute_video_path, volume_format='npy'):
+    stat = os.stat(absolute_video_path)
+    identity = f'{os.path.normcase(absolute_video_path)}|{stat.st_size}|{stat.st_mtime_ns}'
+    if volume_format != 'npy':
+        identity += '|' + volume_format
+    return hashlib.sha1(identity.encode('utf-8')).hexdigest()
+
+
+# Marker left by the first request for a video, so the second one knows to cache it
+def _request_marker_path(cache_dir, key):
+    return os.path.join(cache_dir, key + '.requested')
+
+
+# Every finished volume has a `<key>.npy` (or `<key>.tcdelta`) file with the frames, and a `<key>.json` file with its
+# metadata. The JSON file is written last, so a volume only counts as cached once it has been fully decoded. Its
+# modification time doubles as the volume's "last used" time for LRU eviction.
+def _volume_paths(cache_dir, key, extension=None):
+    if extension is None:
+        # Whichever format the volume was cached in
+        extension = next((extension for extension in VOLUME_EXTENSIONS.values()
+                          if os.path.exists(os.path.join(cache_dir, key + extension))), '.npy')
+    return os.path.join(cache_dir, key + extension), os.path.join(cache_dir, key + '.json')
+
+
+# List the cached volumes as `(last_used, key, size_in_bytes)` tuples, least recently used first
+def list_volumes(cache_dir=None):
+    cache_dir = cache_dir or get_cache_dir()
+    if not os.path.isdir(cache_dir):
+        return []
+    volumes = []
+    for name in os.listdir(cache_dir):
+        if not name.endswith('.json'):
+            continue
+        key = name[:-len('.json')]
+        volume_path, meta_path = _volume_paths(cache_dir, key)
+        try:
+            volumes.append((os.path.getmtime(meta_path), key, os.path.getsize(volume_path)))
+        except OSError:
+            continue
+    volumes.sort()
+    return volumes
+
+
+def _remove_volume(cache_dir, key):
+    volume_path, meta_path = _volume_paths(cache_dir, key)
+    # Remove the metadata first, so a half-deleted volume is never treated as cached
+    for path in (meta_path, volume_path):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+
+# Delete least recently used volumes until `incoming_bytes` more would fit in the budget. Volumes that can't be removed
+# (e.g. because another process still has them mapped on Windows) are skipped.
+def evict(incoming_bytes=0, cache_dir=None, budget_bytes=None):
+    cache_dir = cache_dir or get_cache_dir()
+    budget_bytes = get_budget_bytes() if budget_bytes is None else budget_bytes
+    volumes = list_volumes(cache_dir)
+    total = sum(size for _, _, size in volumes)
+    for _, key, size in volumes:
+        if total + incoming_bytes <= budget_bytes:
+            break
+        try:
+            _remove_volume(cache_dir, key)
+            total -= size
+        except OSError as e:
+            print('Could not evict cached volume', key, ':', e)
+
+
+def clear_cache(cache_dir=None):
+    cache_dir = cache_dir or get_cache_dir()
+    for _, key, _ in list_volumes(cache_dir):
+        _remove_volume(cache_dir, key)
+    if os.path.isdir(cache_dir):
+        for name in os.listdir(cache_dir):
+            if name.endswith('.requested'):
+                os.remove(os.path.join(cache_dir, name))
+
+
+# Decode every frame of `cap` into a new volume at `volume_path`, returning the number of frames actually decoded
+# (which can be lower than the container's reported frame count).
+def _decode_into(cap, volume_path, shape):
+    volume = np.lib.format.open_memmap(volume_path, mode='w+', dtype=np.uint8, shape=shape)
+    num_frames = 0
+    while num_frames < shape[0]:
+        ret, frame = cap.read()
+        if not ret:
+            break
+        volume[num_frames] = frame
+        num_frames += 1
+    volume.flush()
+    del volume
+    return num_frames
+
+
+# Return the decoded volume of the video at `absolute_video_path` as a read-only memory-mapped array (or a
+# `DeltaVolumeReader`, for the `delta` format), along with the frame count the video container reports (which callers
+# should treat as the video's duration, exactly as when decoding it themselves). The volume is decoded and cached first
+# if need be, unless this is the first request for the video and `wait_for_repeat` is set.
+# Returns `(None, None)` if the video isn't cached (yet), or can't be (it is larger than the whole budget, or its frame
+# count is unknown), in which case callers should decode it themselves.
+def load_volume(absolute_video_path, cache_dir=None, budget_bytes=None, wait_for_repeat=True):
+    cache_dir = cache_dir or get_cache_dir()
+    budget_bytes = get_budget_bytes() if budget_bytes is None else budget_bytes
+    volume_format = get_volume_format()
+    key = cache_key(absolute_video_path, volume_format)
+    volume_path, meta_path = _volume_paths(cache_dir, key, VOLUME_EXTENSIONS[volume_format])
+
+    if not os.path.isfile(meta_path):
+        marker_path = _request_marker_path(cache_dir, key)
+        if wait_for_repeat and not os.path.isfile(marker_path):
+            os.makedirs(cache_dir, exist_ok=True)
+            open(marker_path, 'w').close()
+            return None, None
+
+        cap = open_capture(absolute_video_path)
+        width = int(cap.get(cv2.CAP_PROP_FRAME_WIDTH))
+        height = int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
+        reported_frames = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
+        fps = cap.get(cv2.CAP_PROP_FPS)
+        # Delta volumes are usually much smaller, but can't be any larger than this either
+        volume_bytes = reported_frames * height * width * 3
+        if reported_frames <= 0 or volume_bytes > budget_bytes:
+            cap.release()
+            return None, None
+
+        os.makedirs(cache_dir, exist_ok=True)
+        evict(volume_bytes, cache_dir, budget_bytes)
+
+        # Decode into a temporary file and move it into place once complete, so that other processes never map a
+        # partially written volume
+        print(f'Caching decoded frames of {absolute_video_path} in {cache_dir} '
+              f'(up to {volume_bytes / 1024 / 1024:.0f} MB)')
+        temp_path = f'{volume_path}.{os.getpid()}.tmp'
+        try:
+            if volume_format == 'delta':
+                num_frames = delta_volume.encode_capture(cap, temp_path).num_frames
+            else:
+                num_frames = _decode_into(cap, temp_path, (reported_frames, height, width, 3))
+            os.replace(temp_path, volume_path)
+        finally:
+            cap.release()
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+
+        meta = {'video_path': absolute_video_path, 'frames': num_frames, 'reported_frames': reported_frames,
+                'width': width, 'height': height, 'fps': fps, 'format': volume_format, 'created': time.time()}
+        with open(meta_path, 'w') as f:
+            json.dump(meta, f)
+        if os.path.exists(marker_path):
+            os.remove(marker_path)
+
+    with open(meta_path) as f:
+        meta = json.load(f)
+    # Mark the volume as recently used
+    os.utime(meta_path)
+
+    reported_frames = meta.get('reported_frames', meta['frames'])
+    if volume_format == 'delta':
+        return delta_volume.DeltaVolumeReader(volume_path), reported_frames
+    volume = np.load(volume_path, mmap_mode='r')
+    return volume[:meta['frames']], reported_frames
+
+
+if __name__ == "__main__":
+    command = sys.argv[1] if len(sys.argv) > 1 else 'list'
+    if command == 'build':
+        for video_path in sys.argv[2:]:
+            volume, _ = load_volume(os.path.abspath(video_path), wait_for_repeat=False)
+            print(video_path,
+                  'not cached (too large for budget)' if volume is None else f'cached, shape {volume.shape}')
+            if isinstance(volume, delta_volume.DeltaVolumeReader):
+                volume.close()
+    elif command == 'clear':
+        clear_cache()
+        print('Cleared', get_cache_dir())
+    else:
+        for last_used, key, size in list_volumes():
+            print(key, f'{size / 1024 / 1024:.1f} MB', 'last used', time.ctime(last_used))
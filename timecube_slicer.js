@@ -534,6 +534,19 @@ function userExportImage() {
     };
 
     if (isElectron) { // If app is running in electron, let user upload video files
+        // Image exports are progressive: rough previews of the cross-section arrive while the full-resolution image is
+        // still being rendered, and are shown in the loading popup
+        let imageExportRunning = false;
+        window.onPythonProgress(message => {
+            if (imageExportRunning && message.type === 'preview' && message.pass < message.passes && message.url) {
+                Swal.update({
+                    title: `Loading...\n(preview ${message.pass} of ${message.passes - 1})`,
+                    imageUrl: `${message.url}?${new Date().getTime()}`, //adds timestamp to avoid the image getting cached
+                    imageAlt: 'preview of cross section of TIMECUBE',
+                });
+            }
+        });
+
         document.getElementById('imgExport').addEventListener('click', async () => {
 
             // Start the Swal loading popup
@@ -545,6 +558,7 @@ function userExportImage() {
                 Swal.showLoading();
                 }
             });
+            imageExportRunning = true;
 
             try {
                 // Get cooordinates of plane corners
@@ -563,8 +577,9 @@ function userExportImage() {
                 console.log('video: ' + video + ' resolutionPercentage: ' + JSON.stringify(resolutionPercentage));
                 console.log('corner coordinates: ' + JSON.stringify(corners));
                 const scriptName = 'takeVideoCrossSection.py';
-                const args = ['ImageExport', video, JSON.stringify(corners), JSON.stringify(resolutionPercentage)];
+                const args = ['ProgressiveImageExport', video, JSON.stringify(corners), JSON.stringify(resolutionPercentage)];
                 window.runPythonScript(scriptName, args)
+                    .finally(() => imageExportRunning = false)
                     .then(result => {
                         console.log(result);
                         sleep(500) // wait so image can update
@@ -590,6 +605,7 @@ function userExportImage() {
                         Swal.fire('Error', `An error occurred: ${error}`, 'error');
                     });
             } catch (error) {
+                imageExportRunning = false;
                 console.error(`An error occurred: ${error}`);
                 Swal.close();  // Close the Swal loading popup
                 Swal.fire('Error', `An error occurred: ${error}`, 'error');